@@ -25,6 +25,8 @@ from googleapiclient import errors
 _DEFAULT_SCOPES = ('https://www.googleapis.com/auth/cloud-platform',)
 
 
+# The @lru_cache decorator causes this to only be run once per Python session.
+@functools.lru_cache()
 def get_project_name() -> str:
   """Gets the Project ID of the GCP Project."""
   _, project = auth.default()
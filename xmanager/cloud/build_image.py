@@ -13,12 +13,17 @@
 # limitations under the License.
 """Builds images for XManager Docker executables."""
 
+from concurrent import futures
+import hashlib
+import itertools
 import os
 import shutil
 import tempfile
-from typing import Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional, Sequence, TypeVar
 
 from absl import flags
+from absl import logging
+import docker
 from docker.utils import utils as docker_utils
 
 from xmanager import xm
@@ -40,6 +45,25 @@ _USE_DOCKER_COMMAND = flags.DEFINE_boolean(
 _SHOW_DOCKER_COMMAND_PROGRESS = flags.DEFINE_boolean(
     'xm_show_docker_command_progress', False,
     'Show container output during the "docker build".')
+_CACHE_FROM_LATEST = flags.DEFINE_boolean(
+    'xm_build_image_cache_from_latest', False,
+    'Seed local Docker builds with the layers of the image with the same '
+    'repository tagged as :latest, pulling it first if needed. This speeds up '
+    'builds on machines with an empty Docker cache, e.g. CI runners.')
+_SKIP_UNCHANGED_BUILDS = flags.DEFINE_boolean(
+    'xm_skip_unchanged_builds', True,
+    'Reuse the image last built locally for the same repository instead of '
+    'building it again when neither the Dockerfile nor the build context '
+    'changed.')
+_COMPRESSION = flags.DEFINE_enum(
+    'xm_build_image_compression', None, ['gzip', 'estargz', 'zstd'],
+    'Compression of the layers of images built locally with `docker buildx`. '
+    'zstd is several times faster than gzip but requires a registry and a '
+    'container runtime that accept zstd layers, such as Artifact Registry and '
+    'containerd 1.5+.')
+_PARALLEL_BUILDS = flags.DEFINE_boolean(
+    'xm_parallel_builds', False,
+    'Build and push multiple images concurrently rather than one by one.')
 _WRAP_LATE_BINDINGS = flags.DEFINE_boolean(
     'xm_wrap_late_bindings', False,
     'Feature flag to wrap and unwrap late bindings for network addresses. '
@@ -50,18 +74,23 @@ _WRAP_LATE_BINDINGS = flags.DEFINE_boolean(
 # TODO: Find a master image than is compatible with every
 # combination (TF, Torch, JAX) X (CPU, GPU, TPU).
 _DEFAULT_BASE_IMAGE = 'gcr.io/deeplearning-platform-release/base-cu110'
-_DOCKERFILE_TEMPLATE = """
-FROM {base_image}
-
-RUN if ! id 1000; then useradd -m -u 1000 clouduser; fi
-
-{instructions}
-
-COPY entrypoint.sh ./entrypoint.sh
-RUN chown -R 1000:root ./entrypoint.sh && chmod -R 775 ./entrypoint.sh
-
-{entrypoint}
-"""
+# Files that are excluded from the build context of PythonContainers.
+_DOCKERIGNORE_PATTERNS = (
+    '**/.git',
+    '**/__pycache__',
+    '**/*.pyc',
+    '**/.venv',
+    '**/node_modules',
+    '**/.mypy_cache',
+    '**/.pytest_cache',
+    '**/*.egg-info',
+)
+# Builds and pushes run concurrently under --xm_parallel_builds. Each one holds
+# connections to the Docker daemon, whose shared pool is sized for this.
+_MAX_PARALLEL_BUILDS = 16
+# Location of requirements.txt used to install dependencies in the image.
+_REQUIREMENTS_PATH = '/deps/requirements.txt'
+_ReturnType = TypeVar('_ReturnType')
 
 _ENTRYPOINT_TEMPLATE = """#!/bin/bash
 
@@ -87,7 +116,9 @@ def build(py_executable: xm.PythonContainer,
           image_name: Optional[str] = None,
           project: Optional[str] = None,
           bucket: Optional[str] = None,
-          pull_image: bool = False) -> str:
+          pull_image: bool = False,
+          push: bool = False,
+          project_digest: Optional[str] = None) -> str:
   """Build a Docker image from a Python project.
 
   Args:
@@ -98,12 +129,16 @@ def build(py_executable: xm.PythonContainer,
     project: The project to use if CloudBuild is used.
     bucket: The bucket to upload if CloudBuild is used.
     pull_image: Whether to pull the image if CloudBuild is used.
+    push: Whether to push the image if it is built locally. CloudBuild always
+      pushes the image.
+    project_digest: The digest of the project files, see `get_project_digest`.
+      Computed if needed and not set, or if --xm_wrap_late_bindings is set.
 
   Returns:
     The name of the built image.
   """
   if not image_name:
-    image_name = _get_image_name(py_executable)
+    image_name = _get_image_name(py_executable, project)
   dockerfile = _create_dockerfile(py_executable, args, env_vars)
   entrypoint = _create_entrypoint(py_executable)
   dirname = os.path.basename(py_executable.path)
@@ -111,15 +146,26 @@ def build(py_executable: xm.PythonContainer,
 
   with tempfile.TemporaryDirectory() as wrapped_directory:
     if _WRAP_LATE_BINDINGS.value:
-      _wrap_late_bindings(wrapped_directory, python_path, dockerfile)
+      dockerfile = _wrap_late_bindings(wrapped_directory, python_path,
+                                       dockerfile)
       python_path = wrapped_directory
-      dockerfile = os.path.join(python_path, 'Dockerfile')
+
+    digest = None
+    if _BUILD_IMAGE_LOCALLY.value and _SKIP_UNCHANGED_BUILDS.value:
+      if _WRAP_LATE_BINDINGS.value or not project_digest:
+        # The wrapped copy also holds the scripts added by _wrap_late_bindings,
+        # which change with XManager upgrades.
+        project_digest = get_project_digest(python_path)
+      digest = _get_context_digest(dockerfile, entrypoint, project_digest)
 
     with tempfile.TemporaryDirectory() as staging:
       docker_lib.prepare_directory(staging, python_path, dirname, entrypoint,
-                                   dockerfile)
+                                   dockerfile, _get_dockerignore(python_path))
+      with open(os.path.join(staging, '.dockerignore'), 'w') as f:
+        f.write('\n'.join(_create_dockerignore(python_path, dirname)) + '\n')
       return build_by_dockerfile(staging, os.path.join(staging, 'Dockerfile'),
-                                 image_name, project, bucket, pull_image)
+                                 image_name, project, bucket, pull_image, push,
+                                 digest)
 
 
 def build_by_dockerfile(path: str,
@@ -127,7 +173,9 @@ def build_by_dockerfile(path: str,
                         image_name: str,
                         project: Optional[str] = None,
                         bucket: Optional[str] = None,
-                        pull_image: bool = False):
+                        pull_image: bool = False,
+                        push: bool = False,
+                        context_digest: Optional[str] = None):
   """Build a Docker image from a Docker directory.
 
   Args:
@@ -137,6 +185,10 @@ def build_by_dockerfile(path: str,
     project: The project to use if CloudBuild is used.
     bucket: The bucket to upload if CloudBuild is used.
     pull_image: Whether to pull the image if CloudBuild is used.
+    push: Whether to push the image if it is built locally. CloudBuild always
+      pushes the image.
+    context_digest: The digest of the build context, see
+      `docker_lib.context_digest`. Computed from `path` if not set.
 
   Returns:
     The name of the built image.
@@ -144,40 +196,142 @@ def build_by_dockerfile(path: str,
   print('Building Docker image, please wait...')
   if _BUILD_IMAGE_LOCALLY.value:
     if docker_lib.is_docker_installed():
+      repository, _ = docker_utils.parse_repository_tag(image_name)
+      cache_from = None
+      if _CACHE_FROM_LATEST.value:
+        cache_from = [f'{repository}:latest']
+      labels = None
+      # Showing progress disables the cache, i.e. asks for an actual rebuild.
+      # Only `docker buildx` pushes layers with another compression than gzip,
+      # so such pushes go through the build, which reuses the cached layers.
+      if (_SKIP_UNCHANGED_BUILDS.value and
+          not _SHOW_DOCKER_COMMAND_PROGRESS.value and
+          not (push and _USE_DOCKER_COMMAND.value and _COMPRESSION.value)):
+        digest = _get_build_digest(
+            context_digest or docker_lib.context_digest(path, dockerfile),
+            cache_from)
+        if docker_lib.tag_unchanged_image(image_name, digest):
+          print('The build context has not changed, reusing the last image.')
+          if push:
+            docker_lib.push_docker_image(image_name)
+          return image_name
+        labels = {docker_lib.CONTEXT_DIGEST_LABEL: digest}
+      if cache_from and not _USE_DOCKER_COMMAND.value:
+        # Unlike BuildKit, the legacy builder only uses local images as cache.
+        try:
+          docker_adapter.instance().pull_image(cache_from[0])
+        except docker.errors.APIError as e:
+          logging.info('Could not pull the cache image %s: %s', cache_from[0],
+                       e)
       # TODO: Improve out-of-disk space handling.
       return docker_lib.build_docker_image(
           image_name,
           path,
           dockerfile,
           use_docker_command=_USE_DOCKER_COMMAND.value,
-          show_docker_command_progress=_SHOW_DOCKER_COMMAND_PROGRESS.value)
+          show_docker_command_progress=_SHOW_DOCKER_COMMAND_PROGRESS.value,
+          cache_from=cache_from,
+          labels=labels,
+          compression=_COMPRESSION.value,
+          push=push)
     print('Falling back to CloudBuild. See INFO log for details.')
 
-  # If Dockerfile is not a direct child of path, then create a temp directory
-  # that contains both the contents of path and Dockerfile.
-  with tempfile.TemporaryDirectory() as tempdir:
-    if os.path.dirname(dockerfile) != path:
-      new_path = os.path.join(tempdir, os.path.basename(path))
-      shutil.copytree(path, new_path)
-      shutil.copyfile(dockerfile, os.path.join(path, 'Dockerfile'))
-      path = new_path
-
-    cloud_build_client = cloud_build.Client(project=project, bucket=bucket)
-    repository, _ = docker_utils.parse_repository_tag(image_name)
-    upload_name = repository.split('/')[-1]
-    cloud_build_client.build_docker_image(image_name, path, upload_name)
-    if pull_image:
-      docker_adapter.instance().pull_image(image_name)
-    return image_name
+  cloud_build_client = cloud_build.Client(project=project, bucket=bucket)
+  repository, _ = docker_utils.parse_repository_tag(image_name)
+  upload_name = repository.split('/')[-1]
+  # Cloud Build uses the Dockerfile at the root of the uploaded context. Any
+  # other Dockerfile is added to the uploaded archive in its place.
+  if os.path.abspath(dockerfile) == os.path.abspath(
+      os.path.join(path, 'Dockerfile')):
+    dockerfile = None
+  cloud_build_client.build_docker_image(
+      image_name, path, upload_name, dockerfile=dockerfile)
+  if pull_image:
+    docker_adapter.instance().pull_image(image_name)
+  return image_name
 
 
 def push(image: str) -> str:
   return docker_lib.push_docker_image(image)
 
 
-def _get_image_name(py_executable: xm.PythonContainer) -> str:
+def build_many(py_executables: Sequence[xm.PythonContainer],
+               args: Sequence[xm.SequentialArgs],
+               env_vars: Sequence[Dict[str, str]],
+               image_names: Optional[Sequence[Optional[str]]] = None,
+               project: Optional[str] = None,
+               bucket: Optional[str] = None,
+               pull_image: bool = False) -> List[str]:
+  """Builds Docker images for several Python projects.
+
+  The images are built concurrently if --xm_parallel_builds is set.
+
+  Args:
+    py_executables: The PythonContainers to build.
+    args: Args to pass to each of the images.
+    env_vars: Environment variables to set in each of the images.
+    image_names: The image names that will be assigned to the resulting images.
+    project: The project to use if CloudBuild is used.
+    bucket: The bucket to upload if CloudBuild is used.
+    pull_image: Whether to pull the images if CloudBuild is used.
+
+  Returns:
+    The names of the built images, in the order of `py_executables`.
+  """
+  if image_names is None:
+    image_names = [None] * len(py_executables)
+
+  def build_one(py_executable: xm.PythonContainer,
+                executable_args: xm.SequentialArgs,
+                executable_env_vars: Dict[str, str],
+                image_name: Optional[str]) -> str:
+    return build(py_executable, executable_args, executable_env_vars,
+                 image_name, project, bucket, pull_image)
+
+  return parallel_map(build_one, py_executables, args, env_vars, image_names)
+
+
+def push_many(images: Sequence[str]) -> List[str]:
+  """Pushes several images, concurrently if --xm_parallel_builds is set."""
+  return parallel_map(push, images)
+
+
+def parallel_map(function: Callable[..., _ReturnType],
+                 *iterables: Sequence[Any]) -> List[_ReturnType]:
+  """Applies `function` to the items of `iterables` like `map` does.
+
+  The calls run concurrently if --xm_parallel_builds is set, at most
+  _MAX_PARALLEL_BUILDS at a time. Docker builds and pushes mostly wait on the
+  Docker daemon or on remote registries, so threads are enough to run them
+  concurrently.
+
+  Args:
+    function: The function to apply.
+    *iterables: Sequences of arguments, one per parameter of `function`.
+
+  Returns:
+    The results of `function` in the order of the arguments.
+  """
+  count = min(len(iterable) for iterable in iterables)
+  if not _PARALLEL_BUILDS.value or count <= 1:
+    return list(map(function, *iterables))
+  with futures.ThreadPoolExecutor(
+      max_workers=min(count, _MAX_PARALLEL_BUILDS)) as executor:
+    return list(executor.map(function, *iterables))
+
+
+def _uses_buildkit() -> bool:
+  """Whether `build_by_dockerfile` builds the Dockerfile with BuildKit."""
+  if _BUILD_IMAGE_LOCALLY.value and docker_lib.is_docker_installed():
+    # Only `docker buildx` uses BuildKit, not the Python docker client.
+    return _USE_DOCKER_COMMAND.value
+  return cloud_build.uses_buildkit()
+
+
+def _get_image_name(py_executable: xm.PythonContainer,
+                    project: Optional[str] = None) -> str:
   image_name = os.path.basename(py_executable.path)
-  project_name = auth.get_project_name()
+  project_name = project or auth.get_project_name()
   tag = docker_lib.create_tag()
   return f'gcr.io/{project_name}/{image_name}:{tag}'
 
@@ -189,20 +343,47 @@ def _get_base_image(py_executable: xm.PythonContainer) -> str:
 
 
 def _create_instructions(py_executable: xm.PythonContainer,
-                         env_vars: Dict[str, str]) -> str:
+                         env_vars: Dict[str, str],
+                         use_cache_mounts: bool = False) -> List[str]:
   """Create Docker instructions."""
-  set_env_vars = [f'ENV {key}="{value}"' for key, value in env_vars.items()]
   if py_executable.docker_instructions:
-    return '\n'.join(py_executable.docker_instructions + set_env_vars)
+    instructions = list(py_executable.docker_instructions)
+  else:
+    directory = os.path.basename(py_executable.path)
+    instructions = default_steps(
+        directory,
+        py_executable.use_deep_module,
+        use_cache_mounts=use_cache_mounts)
+  instructions.extend(
+      f'ENV {key}="{value}"' for key, value in env_vars.items())
+  return instructions
+
 
-  directory = os.path.basename(py_executable.path)
-  return '\n'.join(
-      list(default_steps(directory, py_executable.use_deep_module)) +
-      set_env_vars)
+def default_steps(directory: str,
+                  use_deep_module: bool,
+                  use_cache_mounts: bool = False) -> List[str]:
+  """Default commands to use in the Dockerfile.
 
+  Args:
+    directory: The name of the project directory inside the build context.
+    use_deep_module: Whether the experiment code uses deep module structure.
+    use_cache_mounts: Whether to keep apt and pip caches in BuildKit cache
+      mounts, so that packages are not downloaded again when the layers are
+      rebuilt. Requires BuildKit: the legacy builder, the Python docker client
+      and kaniko reject `RUN --mount`.
 
-def default_steps(directory: str, use_deep_module: bool) -> List[str]:
-  """Default commands to use in the Dockerfile."""
+  Returns:
+    A list of Dockerfile instructions.
+  """
+  apt_prefix = ''
+  pip_prefix = ''
+  if use_cache_mounts:
+    # Debian-based images delete downloaded packages after each install, which
+    # would leave the apt cache mount empty.
+    apt_prefix = ('--mount=type=cache,target=/var/cache/apt,sharing=locked '
+                  '--mount=type=cache,target=/var/lib/apt,sharing=locked '
+                  'rm -f /etc/apt/apt.conf.d/docker-clean && ')
+    pip_prefix = '--mount=type=cache,target=/root/.cache/pip '
   workdir_setup_prefix = []
   workdir_setup_suffix = []
   project_dir = f'/{directory}'
@@ -227,10 +408,14 @@ def default_steps(directory: str, use_deep_module: bool) -> List[str]:
       'ENV LANG=C.UTF-8',
       # Updating and installing on the same line causes cache-busting.
       # https://docs.docker.com/develop/develop-images/dockerfile_best-practices/#run
-      'RUN apt-get update && apt-get install -y git netcat',
-      'RUN python -m pip install --upgrade pip',
-      f'COPY {directory}/requirements.txt {project_dir}/requirements.txt',
-      f'RUN python -m pip install -r {directory}/requirements.txt',
+      f'RUN {apt_prefix}apt-get update && apt-get install -y git netcat',
+      # Dependencies are installed from a copy of requirements.txt that lives
+      # outside of the project directory, so the layers above only depend on
+      # the base image and requirements.txt and are reused when the sources
+      # change.
+      f'COPY {directory}/requirements.txt {_REQUIREMENTS_PATH}',
+      f'RUN {pip_prefix}python -m pip install --upgrade pip && '
+      f'python -m pip install -r {_REQUIREMENTS_PATH}',
       # It is best practice to copy the project directory as late as possible,
       # rather than at the beginning. This allows Docker to reuse cached layers.
       # If copying the project files were the first step, a tiny modification to
@@ -248,17 +433,91 @@ def _create_dockerfile(
     args: xm.SequentialArgs,
     env_vars: Dict[str, str],
 ) -> str:
-  """Creates a Dockerfile from a project executable."""
-  base_image = _get_base_image(py_executable)
-  instructions = _create_instructions(py_executable, env_vars)
-  entrypoint = _create_entrypoint_cmd(args)
-  contents = _DOCKERFILE_TEMPLATE.format(
-      base_image=base_image, instructions=instructions, entrypoint=entrypoint)
+  """Returns the contents of a Dockerfile for a project executable."""
+  use_cache_mounts = (not py_executable.docker_instructions and
+                      _uses_buildkit())
+  # Resolving the frontend image requires access to Docker Hub, so it is only
+  # asked for when the default steps use cache mounts.
+  syntax = ['# syntax=docker/dockerfile:1.4'] if use_cache_mounts else []
+  contents = '\n'.join([
+      *syntax,
+      f'FROM {_get_base_image(py_executable)}',
+      '',
+      'RUN if ! id 1000; then useradd -m -u 1000 clouduser; fi',
+      '',
+      *_create_instructions(py_executable, env_vars, use_cache_mounts),
+      '',
+      'COPY entrypoint.sh ./entrypoint.sh',
+      'RUN chown -R 1000:root ./entrypoint.sh && chmod -R 775 ./entrypoint.sh',
+      '',
+      _create_entrypoint_cmd(args),
+      '',
+  ])
   print('Dockerfile:', contents, sep='\n')
-  t = tempfile.NamedTemporaryFile(delete=False)
-  with open(t.name, 'w') as f:
-    f.write(contents)
-  return t.name
+  return contents
+
+
+def _create_dockerignore(path: str, dirname: str) -> List[str]:
+  """Returns .dockerignore patterns for a project staged as dirname/.
+
+  Besides the default patterns, this includes the patterns of the project's own
+  .dockerignore, which are relative to the project directory.
+
+  Args:
+    path: The project directory.
+    dirname: The name of the project directory in the build context.
+
+  Returns:
+    A list of .dockerignore patterns.
+  """
+  patterns = list(_DOCKERIGNORE_PATTERNS)
+  for pattern in docker_lib.read_dockerignore(path):
+    negation = ''
+    if pattern.startswith('!'):
+      negation = '!'
+      pattern = pattern[1:].strip()
+    patterns.append(f'{negation}{dirname}/{pattern.lstrip("/")}')
+  return patterns
+
+
+def get_project_digest(path: str) -> str:
+  """Computes a digest of the project files that `build` puts in the image.
+
+  Files excluded from the build context, e.g. under .git or __pycache__, are
+  not covered, so that merely importing the project or running git commands
+  does not change the digest.
+
+  Args:
+    path: The project directory.
+
+  Returns:
+    The hex SHA256 digest of the project files.
+  """
+  return docker_lib.context_digest(path, patterns=_get_dockerignore(path))
+
+
+def _get_dockerignore(path: str) -> List[str]:
+  """Returns the .dockerignore patterns of a project, relative to it."""
+  return list(_DOCKERIGNORE_PATTERNS) + docker_lib.read_dockerignore(path)
+
+
+def _get_build_digest(context_digest: str,
+                      cache_from: Optional[List[str]]) -> str:
+  """Computes the digest of a build context and of the options to build it."""
+  digest = hashlib.sha256()
+  for part in (context_digest, str(_USE_DOCKER_COMMAND.value),
+               str(_COMPRESSION.value), *(cache_from or [])):
+    digest.update(f'{part}\0'.encode())
+  return digest.hexdigest()
+
+
+def _get_context_digest(dockerfile: str, entrypoint: str,
+                        project_digest: str) -> str:
+  """Computes the digest of a build context staged by `build`."""
+  digest = hashlib.sha256()
+  for part in (dockerfile, entrypoint, project_digest):
+    digest.update(f'{part}\0'.encode())
+  return digest.hexdigest()
 
 
 def _get_entrypoint_commands(py_executable: xm.PythonContainer) -> str:
@@ -279,25 +538,20 @@ def _get_entrypoint_commands(py_executable: xm.PythonContainer) -> str:
 
 
 def _create_entrypoint(py_executable: xm.PythonContainer) -> str:
-  """Create a bash entrypoint based on the base image."""
-  contents = _ENTRYPOINT_TEMPLATE.format(
+  """Returns the contents of a bash entrypoint based on the base image."""
+  return _ENTRYPOINT_TEMPLATE.format(
       cmds=_get_entrypoint_commands(py_executable))
 
-  t = tempfile.NamedTemporaryFile(delete=False)
-  with open(t.name, 'w') as f:
-    f.write(contents)
-  return t.name
-
 
 def _create_entrypoint_cmd(args: xm.SequentialArgs) -> str:
   """Create the entrypoint command with optional args."""
-  entrypoint_args = ['./entrypoint.sh']
-  entrypoint_args.extend(args.to_list(utils.ARG_ESCAPER))
-  entrypoint = ', '.join([f'"{arg}"' for arg in entrypoint_args])
+  entrypoint = ', '.join(
+      f'"{arg}"' for arg in itertools.chain(['./entrypoint.sh'],
+                                            args.to_list(utils.ARG_ESCAPER)))
   return f'ENTRYPOINT [{entrypoint}]'
 
 
-def _wrap_late_bindings(destination: str, path: str, dockerfile: str) -> None:
+def _wrap_late_bindings(destination: str, path: str, dockerfile: str) -> str:
   """Create a new path and dockerfile to wrap/unwrap late-bindings.
 
   TODO: Rather than only working PythonContainer, this method can
@@ -309,14 +563,17 @@ def _wrap_late_bindings(destination: str, path: str, dockerfile: str) -> None:
   which is only known at runtime and cannot be statically defined.
 
   Args:
-    destination: An empty destination to contain the new project path and the
-      new dockerfile will be destination/Dockerfile. The current contents of
-      destination will be deleted.
+    destination: An empty destination to contain the new project path. The
+      current contents of destination will be deleted.
     path: The current project path to build.
-    dockerfile: The current dockerfile path needed to build the project.
+    dockerfile: The contents of the current dockerfile needed to build the
+      project.
+
+  Returns:
+    The contents of the new dockerfile.
   """
   shutil.rmtree(destination)
-  shutil.copytree(path, destination)
+  shutil.copytree(path, destination, copy_function=docker_lib.copy_file)
 
   root_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 
@@ -330,15 +587,10 @@ def _wrap_late_bindings(destination: str, path: str, dockerfile: str) -> None:
       os.path.join(root_dir, 'vizier', 'vizier_worker.py'),
       os.path.join(destination, 'vizier_worker.py'))
 
-  new_dockerfile = os.path.join(destination, 'Dockerfile')
   insert_instructions = [
       'RUN chmod +x ./wrapped_entrypoint.sh',
   ]
-  with open(dockerfile) as f:
-    contents = f.read()
-  contents = contents.replace('ENTRYPOINT',
-                              '\n'.join(insert_instructions + ['ENTRYPOINT']))
-  contents = contents.replace('ENTRYPOINT ["./entrypoint.sh',
-                              'ENTRYPOINT ["./wrapped_entrypoint.sh')
-  with open(new_dockerfile, 'w') as f:
-    f.write(contents)
+  contents = dockerfile.replace(
+      'ENTRYPOINT', '\n'.join(insert_instructions + ['ENTRYPOINT']))
+  return contents.replace('ENTRYPOINT ["./entrypoint.sh',
+                          'ENTRYPOINT ["./wrapped_entrypoint.sh')
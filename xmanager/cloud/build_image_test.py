@@ -1,4 +1,7 @@
+from unittest import mock
+
 from absl.testing import absltest
+from absl.testing import flagsaver
 from xmanager import xm
 from xmanager.cloud import build_image
 
@@ -38,6 +41,109 @@ class BuildImageTest(absltest.TestCase):
     entrypoint_commands = build_image._get_entrypoint_commands(project)
     self.assertEndsWith(entrypoint_commands, ' \'$@\' "$@"')
 
+  def test_create_entrypoint_cmd(self):
+    args = xm.merge_args(['a b'], {'c': 1, 'd': True})
+    self.assertEqual(
+        build_image._create_entrypoint_cmd(args),
+        'ENTRYPOINT ["./entrypoint.sh", "\'a b\'", "--c=1", "--d"]')
+
+  def test_create_dockerignore_includes_project_patterns(self):
+    project = self.create_tempdir()
+    project.create_file('.dockerignore', '# Comment\n\n/data\n!data/keep\n')
+    patterns = build_image._create_dockerignore(project.full_path, 'project')
+    self.assertIn('**/.git', patterns)
+    self.assertEqual(patterns[-2:], ['project/data', '!project/data/keep'])
+
+  def test_project_digest_skips_excluded_files(self):
+    project = self.create_tempdir()
+    project.create_file('main.py', 'print("hello")\n')
+    digest = build_image.get_project_digest(project.full_path)
+    project.create_file('.git/HEAD', 'ref: refs/heads/main\n')
+    project.create_file('__pycache__/main.cpython-39.pyc', '\0')
+    self.assertEqual(digest, build_image.get_project_digest(project.full_path))
+
+  @flagsaver.flagsaver(xm_wrap_late_bindings=True)
+  def test_build_digest_covers_late_binding_scripts(self):
+    project = self.create_tempdir()
+    project.create_file('main.py')
+    container = xm.PythonContainer(
+        path=project.full_path, entrypoint=xm.ModuleName('main'))
+    with mock.patch.object(build_image,
+                           'build_by_dockerfile') as build_by_dockerfile, \
+         mock.patch.object(build_image, 'get_project_digest',
+                           wraps=build_image.get_project_digest) as digest:
+      build_image.build(
+          container, xm.SequentialArgs(), {}, 'image:tag',
+          project_digest='project')
+    self.assertNotEqual(digest.call_args[0][0], project.full_path)
+    self.assertIsNotNone(build_by_dockerfile.call_args[0][-1])
+
+  def test_default_steps_install_requirements_before_copying_project(self):
+    steps = build_image.default_steps('project', use_deep_module=False)
+    install_index = next(
+        i for i, step in enumerate(steps) if 'pip install -r' in step)
+    copy_index = steps.index('COPY project/ /project')
+    self.assertLess(install_index, copy_index)
+    self.assertNotIn('/project', ' '.join(steps[:copy_index]))
+
+  def test_default_steps_cache_mounts(self):
+    steps = build_image.default_steps('project', use_deep_module=False)
+    self.assertFalse(any('--mount' in step for step in steps))
+
+    steps = build_image.default_steps(
+        'project', use_deep_module=False, use_cache_mounts=True)
+    self.assertTrue(any('--mount=type=cache' in step for step in steps))
+
+  @flagsaver.flagsaver(xm_build_image_locally=False, xm_use_kaniko=False)
+  def test_create_dockerfile_custom_instructions_has_no_syntax(self):
+    container = xm.PythonContainer(
+        path='/project',
+        entrypoint=xm.ModuleName('main'),
+        docker_instructions=['COPY project/ /project'])
+    dockerfile = build_image._create_dockerfile(container, xm.SequentialArgs(),
+                                                {})
+    self.assertNotIn('# syntax', dockerfile)
+
+  @flagsaver.flagsaver(xm_build_image_locally=False, xm_use_kaniko=False)
+  def test_create_dockerfile_cache_mounts_have_syntax(self):
+    container = xm.PythonContainer(
+        path='/project', entrypoint=xm.ModuleName('main'))
+    dockerfile = build_image._create_dockerfile(container, xm.SequentialArgs(),
+                                                {})
+    self.assertStartsWith(dockerfile, '# syntax=docker/dockerfile:1.4\n')
+    self.assertIn('--mount=type=cache', dockerfile)
+
+  @flagsaver.flagsaver(xm_build_image_locally=False, xm_use_kaniko=True)
+  def test_no_cache_mounts_with_kaniko(self):
+    self.assertFalse(build_image._uses_buildkit())
+
+  @flagsaver.flagsaver(xm_build_image_compression='zstd')
+  def test_build_by_dockerfile_pushes_compressed_layers_from_build(self):
+    with mock.patch.object(build_image.docker_lib, 'is_docker_installed',
+                           return_value=True), \
+         mock.patch.object(build_image.docker_lib,
+                           'tag_unchanged_image') as tag_unchanged_image, \
+         mock.patch.object(build_image.docker_lib,
+                           'build_docker_image') as build_docker_image:
+      build_image.build_by_dockerfile(
+          'path', 'path/Dockerfile', 'image:tag', push=True,
+          context_digest='digest')
+    tag_unchanged_image.assert_not_called()
+    self.assertEqual(build_docker_image.call_args[1]['compression'], 'zstd')
+
+  def test_build_digest_covers_build_options(self):
+    digest = build_image._get_build_digest('context', None)
+    self.assertNotEqual(digest,
+                        build_image._get_build_digest('context', ['image']))
+    with flagsaver.flagsaver(xm_build_image_compression='zstd'):
+      self.assertNotEqual(digest,
+                          build_image._get_build_digest('context', None))
+
+  @flagsaver.flagsaver(xm_parallel_builds=True)
+  def test_push_many_preserves_order(self):
+    with mock.patch.object(build_image, 'push', side_effect=lambda x: x + '!'):
+      self.assertEqual(build_image.push_many(['a', 'b', 'c']), ['a!', 'b!', 'c!'])
+
 
 if __name__ == '__main__':
   absltest.main()
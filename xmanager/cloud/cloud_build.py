@@ -14,6 +14,7 @@
 """Client for interacting with Cloud Build."""
 import datetime
 import getpass
+import os
 import tarfile
 import tempfile
 import time
@@ -26,6 +27,7 @@ from googleapiclient import discovery
 import termcolor
 
 from xmanager.cloud import auth
+from xmanager.cloud import docker_lib
 
 _CLOUD_BUILD_TIMEOUT_SECONDS = flags.DEFINE_integer(
     'xm_cloud_build_timeout_seconds', 1200,
@@ -46,6 +48,11 @@ _KANIKO_CACHE_TTL = flags.DEFINE_string('xm_kaniko_cache_ttl', '336h',
                                         'Cache ttl to use for kaniko builds.')
 
 
+def uses_buildkit() -> bool:
+  """Whether Cloud Build builds Dockerfiles with BuildKit by default."""
+  return not _USE_KANIKO.value
+
+
 class Client:
   """Cloud Build Client."""
 
@@ -102,18 +109,47 @@ class Client:
     blob = bucket.blob(destination_name)
     blob.upload_from_filename(archive_path)
 
-  def build_docker_image(self, image: str, directory: str,
-                         upload_name: str) -> str:
-    """Create a Docker image via Cloud Build and push to Cloud Repository."""
+  def build_docker_image(self,
+                         image: str,
+                         directory: str,
+                         upload_name: str,
+                         dockerfile: Optional[str] = None) -> str:
+    """Create a Docker image via Cloud Build and push to Cloud Repository.
+
+    Args:
+      image: The name of the image to build.
+      directory: The directory to use for the Docker build context.
+      upload_name: The name of the uploaded context archive.
+      dockerfile: The path of the Dockerfile to build instead of
+        directory/Dockerfile. It is added to the context archive in place of
+        directory/Dockerfile, without modifying directory.
+
+    Returns:
+      The URI of the built image.
+    """
     repository, tag = docker_utils.parse_repository_tag(image)
     if not tag:
       tag = datetime.datetime.now().strftime('%Y%m%d-%H%M%S_%f')
 
-    _, archive_path = tempfile.mkstemp(suffix='.tar.gz')
-    with tarfile.open(archive_path, 'w:gz') as tar:
-      tar.add(directory, '/')
     destination_path = f'{getpass.getuser()}/{upload_name}-{tag}.tar.gz'
-    self.upload_tar_to_storage(archive_path, destination_path)
+    fd, archive_path = tempfile.mkstemp(suffix='.tar.gz')
+    try:
+      # Write the archive through the descriptor returned by mkstemp rather
+      # than opening the file a second time by name.
+      with os.fdopen(fd, 'wb') as f:
+        with tarfile.open(fileobj=f, mode='w:gz') as tar:
+          # Files excluded by the .dockerignore are not uploaded at all.
+          paths = docker_lib.included_paths(
+              directory, docker_lib.read_dockerignore(directory))
+          if dockerfile:
+            paths.discard('Dockerfile')
+          for path in sorted(paths):
+            tar.add(os.path.join(directory, path), path, recursive=False)
+          if dockerfile:
+            tar.add(dockerfile, 'Dockerfile')
+      self.upload_tar_to_storage(archive_path, destination_path)
+    finally:
+      os.remove(archive_path)
     build_body = self._build_request_body(destination_path, repository, tag)
     # Note: On GCP cache_discovery=True (the default) leads to ugly error
     # messages as file_cache is unavailable.
@@ -155,17 +191,33 @@ class Client:
           }]
       })
     else:
-      args_for_cached_image = (['--cache-from', f'{repository}:latest']
-                               if self.use_cloud_build_cache else [])
+      steps = []
+      args_for_cached_image = []
+      if self.use_cloud_build_cache:
+        # Pull the cache image so that its layers are available to the build.
+        # The build should still succeed if it does not exist yet.
+        steps.append({
+            'name': 'gcr.io/cloud-builders/docker',
+            'entrypoint': 'bash',
+            'args': [
+                '-c', f'docker pull {repository}:latest || exit 0'
+            ],
+        })
+        args_for_cached_image = [
+            '--cache-from', f'{repository}:latest', '--build-arg',
+            'BUILDKIT_INLINE_CACHE=1'
+        ]
+      steps.append({
+          'name':
+              'gcr.io/cloud-builders/docker',
+          'args': [
+              'build', '-t', f'{repository}:{tag}', '-t',
+              f'{repository}:latest'
+          ] + args_for_cached_image + ['.'],
+          'env': ['DOCKER_BUILDKIT=1'],
+      })
       body.update({
-          'steps': [{
-              'name':
-                  'gcr.io/cloud-builders/docker',
-              'args': [
-                  'build', '-t', f'{repository}:{tag}', '-t',
-                  f'{repository}:latest'
-              ] + args_for_cached_image + ['.'],
-          }],
+          'steps': steps,
           'options': {
               'machineType': 'E2_HIGHCPU_32'
           },
@@ -12,6 +12,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """Tests for cloud_build."""
+import os
+import tarfile
+from unittest import mock
+
 from absl.testing import absltest
 
 from xmanager.cloud import cloud_build
@@ -44,6 +48,7 @@ class CloudBuildTest(absltest.TestCase):
                     'build', '-t', 'my-image:live', '-t', 'my-image:latest', '.'
                 ],
                 'name': 'gcr.io/cloud-builders/docker',
+                'env': ['DOCKER_BUILDKIT=1'],
             }],
             'timeout': '1200s'
         })
@@ -97,6 +102,10 @@ class CloudBuildTest(absltest.TestCase):
                 },
             },
             'steps': [{
+                'args': ['-c', 'docker pull my-image:latest || exit 0'],
+                'entrypoint': 'bash',
+                'name': 'gcr.io/cloud-builders/docker',
+            }, {
                 'args': [
                     'build',
                     '-t',
@@ -105,13 +114,81 @@ class CloudBuildTest(absltest.TestCase):
                     'my-image:latest',
                     '--cache-from',
                     'my-image:latest',
+                    '--build-arg',
+                    'BUILDKIT_INLINE_CACHE=1',
                     '.',
                 ],
                 'name': 'gcr.io/cloud-builders/docker',
+                'env': ['DOCKER_BUILDKIT=1'],
             }],
             'timeout': '1200s'
         })
 
+  def test_build_docker_image_replaces_dockerfile(self):
+    context = self.create_tempdir()
+    context.create_file('Dockerfile', 'FROM original')
+    context.create_file('main.py')
+    dockerfile = self.create_tempfile('Dockerfile.custom', 'FROM custom')
+    client = cloud_build.Client(
+        'my-project',
+        'my-bucket',
+        'fake-creds',
+        use_kaniko=False,
+        use_cloud_build_cache=False)
+    client.cloudbuild_api = mock.MagicMock()
+    archives = {}
+
+    def upload_tar_to_storage(archive_path, destination_name):
+      with tarfile.open(archive_path) as tar:
+        archives[destination_name] = {
+            member.name: tar.extractfile(member).read()
+            for member in tar.getmembers()
+            if member.isfile()
+        }
+
+    with mock.patch.object(client, 'upload_tar_to_storage',
+                           upload_tar_to_storage), \
+         mock.patch.object(client, 'wait_for_build'):
+      client.build_docker_image(
+          'my-image:live',
+          context.full_path,
+          'my-image',
+          dockerfile=dockerfile.full_path)
+
+    [files] = archives.values()
+    self.assertEqual(files, {'Dockerfile': b'FROM custom', 'main.py': b''})
+    self.assertEqual(
+        open(os.path.join(context.full_path, 'Dockerfile')).read(),
+        'FROM original')
+
+  def test_build_docker_image_skips_ignored_files(self):
+    context = self.create_tempdir()
+    context.create_file('Dockerfile', 'FROM original')
+    context.create_file('.dockerignore', '**/.git\n')
+    context.create_file('project/main.py')
+    context.create_file('project/.git/HEAD')
+    client = cloud_build.Client(
+        'my-project',
+        'my-bucket',
+        'fake-creds',
+        use_kaniko=False,
+        use_cloud_build_cache=False)
+    client.cloudbuild_api = mock.MagicMock()
+    names = []
+
+    def upload_tar_to_storage(archive_path, destination_name):
+      del destination_name  # Unused.
+      with tarfile.open(archive_path) as tar:
+        names.extend(tar.getnames())
+
+    with mock.patch.object(client, 'upload_tar_to_storage',
+                           upload_tar_to_storage), \
+         mock.patch.object(client, 'wait_for_build'):
+      client.build_docker_image('my-image:live', context.full_path, 'my-image')
+
+    self.assertCountEqual(
+        names, ['.dockerignore', 'Dockerfile', 'project', 'project/main.py'])
+
 
 if __name__ == '__main__':
   absltest.main()
@@ -13,27 +13,112 @@
 # limitations under the License.
 """Utility functions for building Docker images."""
 import datetime
+import functools
+import hashlib
+import json
 import os
-import pathlib
 import shutil
 import subprocess
 import sys
-from typing import Optional
+from typing import Dict, List, Optional, Set
 
 from absl import logging
 import docker
+from docker import auth as docker_auth
+from docker.utils import build as docker_build_utils
 from docker.utils import utils as docker_utils
 import humanize
 import termcolor
 
+from xmanager.docker import docker_adapter
+
+# Buffer size used to copy files on Python versions without fast copies.
+_COPY_BUFFER_SIZE = 1024 * 1024
+# Files up to this size are hashed by contents when computing a context digest.
+# Larger files are hashed by size and modification time instead.
+_DIGEST_CONTENTS_MAX_SIZE = 1024 * 1024
+# Image label holding the digest of the build context the image was built from.
+CONTEXT_DIGEST_LABEL = 'xm.context_sha'
+# The platform of the images copied by skopeo. Vertex AI and GKE nodes run
+# amd64, so only this platform of multi-platform images is copied.
+_COPY_PLATFORM = {'os': 'linux', 'architecture': 'amd64'}
+# Registry hosts that are reached over plain HTTP, like the Docker daemon does.
+_LOCAL_REGISTRY_HOSTS = ('localhost', '127.0.0.1', '[::1]')
+
 
 def create_tag() -> str:
   return datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')
 
 
-def prepare_directory(destination_directory: str, source_directory: str,
-                      project_name: str, entrypoint_file: str,
-                      dockerfile: str) -> None:
+def copy_file(src: str, dst: str) -> str:
+  """Copies a file together with its metadata, like `shutil.copy2`.
+
+  Intended as the `copy_function` of `shutil.copytree`. Since Python 3.8,
+  `shutil` copies data in the kernel on Linux and macOS, and with a 1 MiB
+  buffer on Windows. Python 3.7 copies through a 16 KiB buffer, which is slow
+  for large files such as model checkpoints, so a bigger buffer is used there.
+
+  Args:
+    src: The file to copy.
+    dst: The destination file path.
+
+  Returns:
+    The destination file path.
+  """
+  if sys.version_info >= (3, 8):
+    return shutil.copy2(src, dst)
+  with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+    shutil.copyfileobj(fsrc, fdst, _COPY_BUFFER_SIZE)
+  shutil.copystat(src, dst)
+  return dst
+
+
+def included_paths(directory: str,
+                   patterns: List[str],
+                   dockerfile: Optional[str] = None) -> Set[str]:
+  """Returns the paths of a directory that .dockerignore patterns keep.
+
+  Args:
+    directory: The directory to list.
+    patterns: The .dockerignore patterns of the paths to exclude.
+    dockerfile: The path of the Dockerfile relative to `directory`, which is
+      never excluded. Defaults to Dockerfile.
+
+  Returns:
+    The kept files and directories, relative to `directory`, along with the
+    directories containing them.
+  """
+  paths = docker_build_utils.exclude_paths(directory, list(patterns),
+                                           dockerfile)
+  # Directories can be excluded while some of their files are not.
+  for path in list(paths):
+    parent = os.path.dirname(path)
+    while parent and parent not in paths:
+      paths.add(parent)
+      parent = os.path.dirname(parent)
+  return paths
+
+
+def _is_excluded(matcher: docker_build_utils.PatternMatcher, path: str,
+                 is_directory: bool) -> bool:
+  """Whether .dockerignore patterns exclude a path, like Docker does."""
+  if not matcher.matches(path):
+    return False
+  if not is_directory:
+    return True
+  # Files of an excluded directory can still be kept by a pattern like
+  # `!directory/file`, see `PatternMatcher.walk`.
+  path = docker_build_utils.normalize_slashes(path)
+  return not any(pattern.exclusion and pattern.cleaned_pattern.startswith(path)
+                 for pattern in matcher.patterns)
+
+
+def prepare_directory(destination_directory: str,
+                      source_directory: str,
+                      project_name: str,
+                      entrypoint: str,
+                      dockerfile: str,
+                      patterns: Optional[List[str]] = None) -> None:
   """Stage all inputs into the destination directory.
 
   Args:
@@ -41,11 +126,31 @@ def prepare_directory(destination_directory: str, source_directory: str,
     source_directory: The directory to copy files from.
     project_name: The name of the folder inside destination_directory/ that
       source_directory/ files will be copied to.
-    entrypoint_file: The file path of entrypoint.sh.
-    dockerfile: The file path of Dockerfile.
+    entrypoint: The contents of entrypoint.sh.
+    dockerfile: The contents of Dockerfile.
+    patterns: The .dockerignore patterns of the source_directory/ files that
+      are not copied, relative to source_directory/.
   """
-  source_path = pathlib.Path(source_directory)
-  size = sum(f.stat().st_size for f in source_path.glob('**/*') if f.is_file())
+  matcher = docker_build_utils.PatternMatcher(patterns or [])
+
+  def ignore(directory: str, names: List[str]) -> Set[str]:
+    relative_directory = os.path.relpath(directory, source_directory)
+    return {
+        name for name in names if _is_excluded(
+            matcher, os.path.normpath(os.path.join(relative_directory, name)),
+            os.path.isdir(os.path.join(directory, name)))
+    }
+
+  # Symlinked directories are walked into, as copied by `shutil.copytree`.
+  size = 0
+  for directory, directories, files in os.walk(
+      source_directory, followlinks=True):
+    excluded = ignore(directory, directories + files)
+    directories[:] = [name for name in directories if name not in excluded]
+    for name in files:
+      path = os.path.join(directory, name)
+      if name not in excluded and os.path.isfile(path):
+        size += os.path.getsize(path)
   print(f'Size of Docker input: {humanize.naturalsize(size)}')
   if size > 200 * 10**6:
     print(
@@ -53,18 +158,100 @@ def prepare_directory(destination_directory: str, source_directory: str,
             'You are trying to pack over 200MB into a Docker image. '
             'Large images negatively impact build times',
             color='magenta'))
-  shutil.copytree(source_directory,
-                  os.path.join(destination_directory, project_name))
-  shutil.copyfile(dockerfile, os.path.join(destination_directory, 'Dockerfile'))
-  shutil.copyfile(entrypoint_file,
-                  os.path.join(destination_directory, 'entrypoint.sh'))
 
+  shutil.copytree(
+      source_directory,
+      os.path.join(destination_directory, project_name),
+      copy_function=copy_file,
+      ignore=ignore)
+  with open(os.path.join(destination_directory, 'Dockerfile'), 'w') as f:
+    f.write(dockerfile)
+  with open(os.path.join(destination_directory, 'entrypoint.sh'), 'w') as f:
+    f.write(entrypoint)
+
+
+def read_dockerignore(directory: str) -> List[str]:
+  """Returns the patterns of the .dockerignore file of a directory, if any."""
+  dockerignore = os.path.join(directory, '.dockerignore')
+  if not os.path.isfile(dockerignore):
+    return []
+  with open(dockerignore) as f:
+    return [
+        line.strip()
+        for line in f
+        if line.strip() and not line.startswith('#')
+    ]
+
+
+def context_digest(directory: str,
+                   dockerfile: Optional[str] = None,
+                   patterns: Optional[List[str]] = None) -> str:
+  """Computes a digest of a Docker build context.
 
+  The digest covers the Dockerfile and every file of the context that is not
+  excluded by its .dockerignore.
+
+  Args:
+    directory: The directory used as the Docker build context.
+    dockerfile: The path of the Dockerfile. If not set, only the files of the
+      context are covered.
+    patterns: The .dockerignore patterns of the files to exclude. If not set,
+      the .dockerignore file of `directory` is used.
+
+  Returns:
+    The hex SHA256 digest of the build context.
+  """
+  digest = hashlib.sha256()
+  if dockerfile:
+    with open(dockerfile, 'rb') as f:
+      digest.update(f.read())
+    dockerfile = os.path.relpath(dockerfile, directory)
+  if patterns is None:
+    patterns = read_dockerignore(directory)
+  paths = docker_build_utils.exclude_paths(directory, patterns, dockerfile)
+  for path in sorted(paths):
+    full_path = os.path.join(directory, path)
+    if not os.path.isfile(full_path):
+      continue
+    stat = os.stat(full_path)
+    digest.update(f'{path}\0{stat.st_mode}\0{stat.st_size}\0'.encode())
+    if stat.st_size <= _DIGEST_CONTENTS_MAX_SIZE:
+      with open(full_path, 'rb') as f:
+        digest.update(f.read())
+    else:
+      digest.update(f'{stat.st_mtime_ns}\0'.encode())
+  return digest.hexdigest()
+
+
+def tag_unchanged_image(image: str, digest: str) -> bool:
+  """Tags the latest image of the repository if it has the same context digest.
+
+  Args:
+    image: The image name to assign, including its tag.
+    digest: The digest of the build context, see `context_digest`.
+
+  Returns:
+    Whether `image` now refers to an image built from the same context.
+  """
+  docker_client = docker_adapter.instance().get_client()
+  repository, tag = docker_utils.parse_repository_tag(image)
+  try:
+    latest = docker_client.images.get(f'{repository}:latest')
+  except docker.errors.ImageNotFound:
+    return False
+  if latest.labels.get(CONTEXT_DIGEST_LABEL) != digest:
+    return False
+  latest.tag(repository, tag=tag or 'latest')
+  return True
+
+
+# The @lru_cache decorator causes this to only be run once per Python session.
+@functools.lru_cache()
 def is_docker_installed() -> bool:
   """Checks if Docker is installed and accessible."""
   try:
-    docker_client = docker.from_env()
-    logging.info('Local docker: %s', docker_client.version())
+    logging.info('Local docker: %s',
+                 docker_adapter.instance().get_client().version())
     return True
   except docker.errors.DockerException as e:
     if 'No such file or directory' in str(e):
@@ -84,34 +271,132 @@ def build_docker_image(image: str,
                        directory: str,
                        dockerfile: Optional[str] = None,
                        use_docker_command: bool = True,
-                       show_docker_command_progress: bool = False) -> str:
-  """Builds a Docker image locally."""
+                       show_docker_command_progress: bool = False,
+                       cache_from: Optional[List[str]] = None,
+                       labels: Optional[Dict[str, str]] = None,
+                       client: Optional[docker.DockerClient] = None,
+                       compression: Optional[str] = None,
+                       push: bool = False) -> str:
+  """Builds a Docker image locally.
+
+  With `push`, `docker buildx` pushes the image as part of the build, skipping
+  layers that the registry already has.
+  """
   logging.info('Building Docker image')
-  docker_client = docker.from_env()
+  docker_client = client or docker_adapter.instance().get_client()
   if not dockerfile:
     dockerfile = os.path.join(directory, 'Dockerfile')
   if use_docker_command:
     _build_image_with_docker_command(docker_client, directory, image,
-                                     dockerfile, show_docker_command_progress)
+                                     dockerfile, show_docker_command_progress,
+                                     cache_from, labels, compression, push)
+    if push:
+      print('Your image URI is:', termcolor.colored(image, color='blue'))
   else:
-    _build_image_with_python_client(docker_client, directory, image, dockerfile)
+    if compression:
+      logging.info('Layer compression is only supported by `docker buildx`.')
+    _build_image_with_python_client(docker_client, directory, image, dockerfile,
+                                    cache_from, labels)
+    if push:
+      push_docker_image(image)
   logging.info('Building docker image: Done')
   return image
 
 
+def _is_local_registry(image: str) -> bool:
+  """Checks whether the image is in a registry running on this machine."""
+  repository, _ = docker_utils.parse_repository_tag(image)
+  registry, _ = docker_auth.resolve_repository_name(repository)
+  return registry.rsplit(':', 1)[0] in _LOCAL_REGISTRY_HOSTS
+
+
+def copy_image(source: str,
+               destination: str,
+               parallel_copies: Optional[int] = None) -> None:
+  """Copies an image from one registry to another with skopeo.
+
+  Layers are streamed between the registries instead of being pulled into the
+  local Docker storage and pushed back from there. Registry credentials are
+  read from the Docker config, the same way `docker push` does. Registries on
+  this machine are reached without TLS, e.g. test and CI registries.
+
+  Like a Docker pull and push, only the linux/amd64 image of a multi-platform
+  source is copied. Copying every platform would transfer several times more
+  data, e.g. python:3.9 has 8 platforms.
+
+  Args:
+    source: The image to copy.
+    destination: The name to copy the image to.
+    parallel_copies: The number of layers to copy concurrently. Uses the
+      skopeo default if not set.
+  """
+  command = [
+      'skopeo', '--override-os', _COPY_PLATFORM['os'], '--override-arch',
+      _COPY_PLATFORM['architecture'], 'copy'
+  ]
+  if parallel_copies:
+    command.extend(['--image-parallel-copies', str(parallel_copies)])
+  if _is_local_registry(source):
+    command.append('--src-tls-verify=false')
+  if _is_local_registry(destination):
+    command.append('--dest-tls-verify=false')
+  command.extend([f'docker://{source}', f'docker://{destination}'])
+  subprocess.run(command, check=True)
+
+
+def get_registry_digest(image: str) -> Optional[str]:
+  """Returns the digest of the image `copy_image` copies, with skopeo.
+
+  Args:
+    image: The image to inspect.
+
+  Returns:
+    The digest of the linux/amd64 image manifest, or None if it could not be
+    inspected, e.g. because the image does not exist.
+  """
+  command = ['skopeo', 'inspect', '--raw']
+  if _is_local_registry(image):
+    command.append('--tls-verify=false')
+  command.append(f'docker://{image}')
+  result = subprocess.run(
+      command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  if result.returncode:
+    logging.info('Could not inspect %s: %s', image, result.stderr.decode())
+    return None
+  manifest = json.loads(result.stdout)
+  if 'manifests' not in manifest:
+    # The digest of a manifest is the digest of its exact bytes.
+    return 'sha256:' + hashlib.sha256(result.stdout).hexdigest()
+  # A manifest list or OCI index refers to the manifest of each platform.
+  for entry in manifest['manifests']:
+    platform = entry.get('platform', {})
+    if all(platform.get(key) == value for key, value in _COPY_PLATFORM.items()):
+      return entry['digest']
+  return None
+
+
 def push_docker_image(image: str) -> str:
-  """Pushes a Docker image to the designated repository."""
-  docker_client = docker.from_env()
-  repository, tag = docker_utils.parse_repository_tag(image)
-  push = docker_client.images.push(repository=repository, tag=tag)
-  logging.info(push)
-  if not isinstance(push, str) or '"Digest":' not in push:
+  """Pushes a Docker image to the designated repository.
+
+  The Docker daemon already uploads the layers of an image concurrently. The
+  Engine API has no way to push individual layers, so the concurrency is tuned
+  with `max-concurrent-uploads` in the daemon configuration (5 by default).
+
+  Args:
+    image: The image to push, including its tag.
+
+  Returns:
+    The pushed image.
+  """
+  adapter = docker_adapter.instance()
+  if adapter.push_image(image) is None:
     raise RuntimeError(
-        'Expected docker push to return a string with `status: Pushed` and a '
-        'Digest. This is probably a temporary issue with --build_locally and '
-        'you should try again')
+        'Expected docker push to report the Digest of the pushed image. This '
+        'is probably a temporary issue with --build_locally and you should '
+        'try again')
   # If we are pushing an image, then :latest should also be present.
-  docker_client.images.push(repository=repository, tag='latest')
+  repository, _ = adapter.split_tag(image)
+  adapter.push_image(f'{repository}:latest')
   print('Your image URI is:', termcolor.colored(image, color='blue'))
   return image
 
@@ -120,7 +405,11 @@ def _build_image_with_docker_command(client: docker.DockerClient,
                                      path: str,
                                      image_tag: str,
                                      dockerfile: str,
-                                     progress: bool = False) -> None:
+                                     progress: bool = False,
+                                     cache_from: Optional[List[str]] = None,
+                                     labels: Optional[Dict[str, str]] = None,
+                                     compression: Optional[str] = None,
+                                     push: bool = False) -> None:
   """Builds a Docker image by calling `docker build` within a subprocess."""
   version = client.version()['Version']
   [major, minor] = version.split('.')[:2]
@@ -134,6 +423,25 @@ def _build_image_with_docker_command(client: docker.DockerClient,
       'docker', 'buildx', 'build', '-t', f'{repository}:{tag}', '-t',
       f'{repository}:latest', '-f', dockerfile, path
   ]
+  if cache_from or push:
+    # BuildKit only reuses layers of images that carry inline cache metadata,
+    # so embed it to make the resulting image usable as a cache source too.
+    cache_args = ['--build-arg', 'BUILDKIT_INLINE_CACHE=1']
+    for image in cache_from or []:
+      cache_args.extend(['--cache-from', image])
+    command[3:3] = cache_args
+  for key, value in (labels or {}).items():
+    command[3:3] = ['--label', f'{key}={value}']
+  output = []
+  if compression:
+    # Layers are compressed when BuildKit pushes the image. Images pushed by
+    # the Docker daemon are always compressed with gzip.
+    output.append(f'compression={compression},force-compression=true')
+  if push:
+    # Pushes every tag of the image after it is built.
+    output.append('push=true')
+  if output:
+    command[3:3] = ['--output', ','.join(['type=image'] + output)]
 
   # Adding flags to show progress and disabling cache.
   # Caching prevents actual commands in layer from executing.
@@ -141,24 +449,37 @@ def _build_image_with_docker_command(client: docker.DockerClient,
   if progress:
     command[2:2] = ['--progress', 'plain', '--no-cache']
 
-  subprocess.run(command, check=True, env={'DOCKER_BUILDKIT': '1'})
+  subprocess.run(
+      command, check=True, env={
+          **os.environ, 'DOCKER_BUILDKIT': '1'
+      })
 
 
-def _build_image_with_python_client(client: docker.DockerClient, path: str,
-                                    image_tag: str, dockerfile: str) -> None:
+def _build_image_with_python_client(
+    client: docker.DockerClient,
+    path: str,
+    image_tag: str,
+    dockerfile: str,
+    cache_from: Optional[List[str]] = None,
+    labels: Optional[Dict[str, str]] = None) -> None:
   """Builds a Docker image by calling the Docker Python client."""
   repository, tag = docker_utils.parse_repository_tag(image_tag)
   if not tag:
     tag = 'latest'
   try:
     # The `tag=` arg refers to the full repository:tag image name.
-    _, logs = client.images.build(
-        path=path, tag=f'{repository}:{tag}', dockerfile=dockerfile)
-    client.images.build(
-        path=path, tag=f'{repository}:latest', dockerfile=dockerfile)
+    image, logs = client.images.build(
+        path=path,
+        tag=f'{repository}:{tag}',
+        dockerfile=dockerfile,
+        cache_from=cache_from,
+        labels=labels)
   except docker.errors.BuildError as error:
     for log in error.build_log:
       print(log.get('stream', ''), end='', file=sys.stderr)
     raise error
   for log in logs:
     print(log.get('stream', ''), end='')
+  # Tag the same image rather than building it a second time, which would
+  # archive and upload the whole build context to the daemon again.
+  image.tag(repository, tag='latest')
@@ -0,0 +1,171 @@
+import hashlib
+import json
+import os
+from unittest import mock
+
+from absl.testing import absltest
+from absl.testing import flagsaver
+from xmanager.cloud import docker_lib
+from xmanager.docker import docker_adapter
+
+
+class DockerLibTest(absltest.TestCase):
+
+  def create_context(self):
+    directory = self.create_tempdir().full_path
+    with open(os.path.join(directory, 'Dockerfile'), 'w') as f:
+      f.write('FROM python:3.9\nCOPY . /app\n')
+    with open(os.path.join(directory, 'main.py'), 'w') as f:
+      f.write('print("hello")\n')
+    with open(os.path.join(directory, '.dockerignore'), 'w') as f:
+      f.write('# Comment\n*.pyc\n')
+    return directory
+
+  def test_context_digest_is_stable(self):
+    directory = self.create_context()
+    dockerfile = os.path.join(directory, 'Dockerfile')
+    self.assertEqual(
+        docker_lib.context_digest(directory, dockerfile),
+        docker_lib.context_digest(directory, dockerfile))
+
+  def test_context_digest_changes_with_context(self):
+    directory = self.create_context()
+    dockerfile = os.path.join(directory, 'Dockerfile')
+    digest = docker_lib.context_digest(directory, dockerfile)
+    with open(os.path.join(directory, 'main.py'), 'w') as f:
+      f.write('print("world")\n')
+    self.assertNotEqual(digest, docker_lib.context_digest(directory, dockerfile))
+
+  def test_context_digest_skips_ignored_files(self):
+    directory = self.create_context()
+    dockerfile = os.path.join(directory, 'Dockerfile')
+    digest = docker_lib.context_digest(directory, dockerfile)
+    with open(os.path.join(directory, 'main.pyc'), 'wb') as f:
+      f.write(b'\0')
+    self.assertEqual(digest, docker_lib.context_digest(directory, dockerfile))
+
+  def test_prepare_directory_skips_ignored_files(self):
+    source = self.create_tempdir()
+    source.create_file('main.py')
+    source.create_file('.git/HEAD')
+    source.create_file('data/skip.csv')
+    source.create_file('data/keep.csv')
+    destination = self.create_tempdir().full_path
+    docker_lib.prepare_directory(destination, source.full_path, 'project',
+                                 'entrypoint', 'dockerfile',
+                                 ['**/.git', 'data', '!data/keep.csv'])
+    project = os.path.join(destination, 'project')
+    self.assertCountEqual(os.listdir(project), ['main.py', 'data'])
+    self.assertEqual(os.listdir(os.path.join(project, 'data')), ['keep.csv'])
+
+  def test_prepare_directory_copies_symlinked_directories(self):
+    shared = self.create_tempdir()
+    shared.create_file('a.py')
+    shared.create_file('__pycache__/a.pyc')
+    source = self.create_tempdir().full_path
+    os.symlink(shared.full_path, os.path.join(source, 'shared'))
+    destination = self.create_tempdir().full_path
+    docker_lib.prepare_directory(destination, source, 'project', 'entrypoint',
+                                 'dockerfile', ['**/__pycache__'])
+    self.assertEqual(
+        os.listdir(os.path.join(destination, 'project', 'shared')), ['a.py'])
+
+  def test_push_docker_image_raises_on_error(self):
+    client = mock.MagicMock()
+    client.images.push.return_value = iter([{'status': 'Preparing'},
+                                            {'error': 'denied'}])
+    with mock.patch.object(docker_adapter, 'instance',
+                           return_value=docker_adapter.DockerAdapter(client)):
+      with self.assertRaises(docker_lib.docker.errors.APIError):
+        docker_lib.push_docker_image('gcr.io/project/image:tag')
+
+  def test_push_docker_image_pushes_latest(self):
+    client = mock.MagicMock()
+    client.images.push.side_effect = lambda *_, **__: iter(
+        [{'aux': {'Tag': 'tag', 'Digest': 'sha256:a'}}])
+    with mock.patch.object(docker_adapter, 'instance',
+                           return_value=docker_adapter.DockerAdapter(client)):
+      docker_lib.push_docker_image('gcr.io/project/image:tag')
+    client.images.push.assert_has_calls([
+        mock.call('gcr.io/project/image', tag='tag', stream=True, decode=True),
+        mock.call(
+            'gcr.io/project/image', tag='latest', stream=True, decode=True),
+    ])
+
+  @mock.patch.object(docker_lib.subprocess, 'run')
+  def test_build_image_with_docker_command_compression(self, run):
+    client = mock.MagicMock()
+    client.version.return_value = {'Version': '20.10.7'}
+    docker_lib.build_docker_image(
+        'image:tag', '/context', client=client, compression='zstd')
+    command = run.call_args[0][0]
+    self.assertIn('type=image,compression=zstd,force-compression=true',
+                  command)
+
+  @mock.patch.object(docker_lib.subprocess, 'run')
+  def test_get_registry_digest_of_platform(self, run):
+    run.return_value.returncode = 0
+    run.return_value.stdout = json.dumps({
+        'manifests': [
+            {
+                'digest': 'sha256:arm',
+                'platform': {'os': 'linux', 'architecture': 'arm64'},
+            },
+            {
+                'digest': 'sha256:amd',
+                'platform': {'os': 'linux', 'architecture': 'amd64'},
+            },
+        ]
+    }).encode()
+    self.assertEqual(docker_lib.get_registry_digest('python:3.9'), 'sha256:amd')
+
+  @mock.patch.object(docker_lib.subprocess, 'run')
+  def test_get_registry_digest_of_manifest(self, run):
+    run.return_value.returncode = 0
+    run.return_value.stdout = b'{"layers": []}'
+    self.assertEqual(
+        docker_lib.get_registry_digest('gcr.io/project/python:3.9'),
+        'sha256:' + hashlib.sha256(b'{"layers": []}').hexdigest())
+
+  @mock.patch.object(docker_lib.subprocess, 'run')
+  def test_copy_image_to_local_registry(self, run):
+    docker_lib.copy_image('python:3.9', 'localhost:5000/python:3.9')
+    command = run.call_args[0][0]
+    self.assertIn('--dest-tls-verify=false', command)
+    self.assertNotIn('--src-tls-verify=false', command)
+
+  @mock.patch.object(docker_lib.subprocess, 'run')
+  def test_build_image_with_docker_command_push(self, run):
+    client = mock.MagicMock()
+    client.version.return_value = {'Version': '20.10.7'}
+    docker_lib.build_docker_image(
+        'image:tag', '/context', client=client, compression='zstd', push=True)
+    command = run.call_args[0][0]
+    self.assertIn(
+        'type=image,compression=zstd,force-compression=true,push=true',
+        command)
+    self.assertIn('BUILDKIT_INLINE_CACHE=1', command)
+    client.images.push.assert_not_called()
+
+  @flagsaver.flagsaver(xm_subprocess_docker_impl=True)
+  @mock.patch.object(docker_adapter.subprocess, 'run')
+  def test_push_docker_image_with_docker_command(self, run):
+    run.return_value.stdout = 'tag: digest: sha256:abc size: 1234\n'
+    with mock.patch.object(docker_adapter, 'instance',
+                           return_value=docker_adapter.DockerAdapter(
+                               mock.MagicMock())):
+      docker_lib.push_docker_image('gcr.io/project/image:tag')
+    run.assert_has_calls([
+        mock.call(['docker', 'push', 'gcr.io/project/image:tag'],
+                  check=True,
+                  stdout=docker_adapter.subprocess.PIPE,
+                  text=True),
+        mock.call(['docker', 'push', 'gcr.io/project/image:latest'],
+                  check=True,
+                  stdout=docker_adapter.subprocess.PIPE,
+                  text=True),
+    ])
+
+
+if __name__ == '__main__':
+  absltest.main()
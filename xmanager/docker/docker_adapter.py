@@ -14,6 +14,7 @@
 """Convenience adapter for the standard client."""
 
 import functools
+import re
 import subprocess
 from typing import Dict, List, Mapping, Optional, Sequence, Tuple, Union
 
@@ -26,7 +27,12 @@ from docker.utils import utils
 
 _USE_SUBPROCESS = flags.DEFINE_bool(
     'xm_subprocess_docker_impl', False,
-    'Launch docker using `subprocess` command.')
+    'Launch docker using `subprocess` command. This also applies to image '
+    'pushes.')
+
+# Connections kept open to the Docker daemon. The docker library keeps 10, fewer
+# than the up to 16 concurrent builds and pushes of --xm_parallel_builds need.
+_MAX_POOL_SIZE = 32
 
 Ports = Dict[Union[int, str], Union[None, int, Tuple[str, int], List[int]]]
 
@@ -38,7 +44,12 @@ def instance() -> 'DockerAdapter':
   Allows the user to ignore the complexities of the underlying library, and
   focus on a concrete small subset of required actions.
   """
-  return DockerAdapter(docker.from_env())
+  return DockerAdapter(create_client())
+
+
+def create_client() -> docker.DockerClient:
+  """Creates a client from the environment that may be shared by threads."""
+  return docker.from_env(max_pool_size=_MAX_POOL_SIZE)
 
 
 class DockerAdapter(object):
@@ -73,6 +84,43 @@ class DockerAdapter(object):
     # From docker>=4.4.0, use `client.image.pull(*args, all_tags=False)`.
     return self._client.images.pull(repository, tag=tag).id
 
+  def tag_image(self, image_id: str, image_tag: str) -> None:
+    # Tags through the low-level API, which does not inspect the image first.
+    repository, tag = self.split_tag(image_tag)
+    self._client.api.tag(image_id, repository, tag=tag, force=True)
+
+  def push_image(self, image_tag: str) -> Optional[str]:
+    """Pushes an image and returns its digest, if the registry reported it."""
+    if _USE_SUBPROCESS.value:
+      return self.push_image_subprocess(image_tag)
+    else:
+      return self.push_image_client(image_tag)
+
+  def push_image_client(self, image_tag: str) -> Optional[str]:
+    """Pushes an image using Python Docker client, streaming its progress."""
+    repository, tag = self.split_tag(image_tag)
+    digest = None
+    for event in self._client.images.push(
+        repository, tag=tag, stream=True, decode=True):
+      if 'error' in event:
+        raise errors.APIError(event['error'])
+      if 'aux' in event:
+        digest = event['aux'].get('Digest', digest)
+      logging.debug(event)
+    return digest
+
+  def push_image_subprocess(self, image_tag: str) -> Optional[str]:
+    """Pushes an image calling `docker push` in a Subprocess."""
+    repository, tag = self.split_tag(image_tag)
+    result = subprocess.run(['docker', 'push', f'{repository}:{tag}'],
+                            check=True,
+                            stdout=subprocess.PIPE,
+                            text=True)
+    logging.debug(result.stdout)
+    # The last line reads `<tag>: digest: sha256:<hex> size: <size>`.
+    digest = re.search(r'digest: (\S+)', result.stdout)
+    return digest.group(1) if digest else None
+
   def load_image(self, path: str) -> str:
     with open(path, 'rb') as data:
       images = self._client.images.load(data)
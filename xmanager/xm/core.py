@@ -145,6 +145,28 @@ class NotFoundError(KeyError):
   """Experiment/Work Unit/etc. has not been found."""
 
 
+def _deduce_args_for_job(job: job_blocks.Job) -> Dict[str, Any]:
+  args = {
+      'args': job.args.to_dict(kwargs_only=True),
+      'env_vars': job.env_vars
+  }
+  return {key: value for key, value in args.items() if value}
+
+
+def _deduce_args_for_job_group(group: job_blocks.JobGroup) -> Dict[str, Any]:
+  args = {}
+  for job_name, job in group.jobs.items():
+    job_args = _deduce_args(job)
+    if job_args:
+      args[job_name] = job_args
+  return args
+
+
+_deduce_args = pattern_matching.match(
+    _deduce_args_for_job, _deduce_args_for_job_group,
+    pattern_matching.Case([job_blocks.JobGeneratorType], lambda generator: {}))
+
+
 def _work_unit_arguments(
     job: job_blocks.JobType,
     args: Optional[Mapping[str, Any]],
@@ -174,27 +196,7 @@ def _work_unit_arguments(
     # don't alter them if a value is given.
     return args
 
-  def deduce_args_for_job(job: job_blocks.Job) -> Dict[str, Any]:
-    args = {
-        'args': job.args.to_dict(kwargs_only=True),
-        'env_vars': job.env_vars
-    }
-    return {key: value for key, value in args.items() if value}
-
-  def deduce_args_for_job_group(group: job_blocks.JobGroup) -> Dict[str, Any]:
-    args = {}
-    for job_name, job in group.jobs.items():
-      job_args = deduce_args(job)
-      if job_args:
-        args[job_name] = job_args
-    return args
-
-  deduce_args = pattern_matching.match(
-      deduce_args_for_job, deduce_args_for_job_group,
-      pattern_matching.Case([job_blocks.JobGeneratorType],
-                            lambda generator: {}))
-
-  return deduce_args(job)
+  return _deduce_args(job)
 
 
 class Importance(enum.Enum):
@@ -14,11 +14,11 @@
 """Data classes for job-related abstractions."""
 
 import abc
+import collections.abc
 from typing import Any, Awaitable, Callable, Dict, List, Mapping, Optional, Sequence, Tuple, TypeVar, Union
 
 import attr
 
-from xmanager.xm import pattern_matching
 from xmanager.xm import utils
 
 UserArgs = Union[Mapping, Sequence, 'SequentialArgs']
@@ -54,46 +54,42 @@ class SequentialArgs:
   keyword arguments. Removal and inserting to the middle is not supported.
   """
 
-  @attr.s(auto_attribs=True)
-  class _RegularItem:
-    value: Any
-
-  @attr.s(auto_attribs=True)
-  class _KeywordItem:
-    name: str
+  __slots__ = ('_items', '_kwindex')
 
   def __init__(self) -> None:
     """Constucts an empty SequentialArgs.
 
     Prefer using xm.merge_args to construct SequentialArgs objects.
     """
-    self._items: List[Union[SequentialArgs._RegularItem,
-                            SequentialArgs._KeywordItem]] = []
-    self._kwvalues: Dict[str, Any] = {}
+    # Items are stored as (name, value) tuples, where name is None for
+    # positional arguments.
+    self._items: List[Tuple[Optional[str], Any]] = []
+    # Positions of keyword arguments in _items.
+    self._kwindex: Dict[str, int] = {}
 
   def _ingest_regular_item(self, value: Any) -> None:
-    self._items.append(SequentialArgs._RegularItem(value))
+    self._items.append((None, value))
 
   def _ingest_keyword_item(self, name: str, value: Any) -> None:
-    if name not in self._kwvalues:
-      self._items.append(SequentialArgs._KeywordItem(name))
-    self._kwvalues[name] = value
+    index = self._kwindex.get(name)
+    if index is None:
+      self._kwindex[name] = len(self._items)
+      self._items.append((name, value))
+    else:
+      self._items[index] = (name, value)
 
   def _merge_from(self, args: 'SequentialArgs') -> None:
     """Merges another instance of SequentialArgs into self."""
+    for name, value in args._items:  # pylint: disable=protected-access
+      if name is None:
+        self._ingest_regular_item(value)
+      else:
+        self._ingest_keyword_item(name, value)
 
-    def import_regular_item(item: SequentialArgs._RegularItem):
-      self._ingest_regular_item(item.value)
-
-    def import_keyword_item(item: SequentialArgs._KeywordItem):
-      self._ingest_keyword_item(item.name, args._kwvalues[item.name])  # pylint: disable=protected-access
-
-    matcher = pattern_matching.match(
-        import_regular_item,
-        import_keyword_item,
-    )
-    for item in args._items:  # pylint: disable=protected-access
-      matcher(item)
+  def _merge_from_mapping(self, mapping: Mapping[Any, Any]) -> None:
+    """Merges keyword arguments given as a mapping into self."""
+    for key, value in mapping.items():
+      self._ingest_keyword_item(str(key), value)
 
   @staticmethod
   def from_collection(collection: Optional[UserArgs]) -> 'SequentialArgs':
@@ -102,25 +98,23 @@ class SequentialArgs:
     if collection is None:
       return result
 
-    def check_for_string(args: str) -> None:
+    if isinstance(collection, str):
       raise ValueError(
-          f'Tried to construct xm.SequentialArgs from a string: {args!r}. '
-          f'Wrap it in a list: [{args!r}] to make it a single argument.')
-
-    def import_sequential_args(args: SequentialArgs) -> None:
-      result._merge_from(args)  # pylint: disable=protected-access
-
-    def import_mapping(collection: Mapping[Any, Any]) -> None:
-      for key, value in collection.items():
-        result._ingest_keyword_item(str(key), value)  # pylint: disable=protected-access
-
-    def import_sequence(collection: Sequence[Any]) -> None:
+          'Tried to construct xm.SequentialArgs from a string: '
+          f'{collection!r}. Wrap it in a list: [{collection!r}] to make it a '
+          'single argument.')
+    elif isinstance(collection, SequentialArgs):
+      result._merge_from(collection)  # pylint: disable=protected-access
+    elif isinstance(collection, collections.abc.Mapping):
+      result._merge_from_mapping(collection)  # pylint: disable=protected-access
+    elif isinstance(collection, collections.abc.Sequence):
       for value in collection:
         result._ingest_regular_item(value)  # pylint: disable=protected-access
-
-    matcher = pattern_matching.match(check_for_string, import_sequential_args,
-                                     import_mapping, import_sequence)
-    matcher(collection)
+    else:
+      raise TypeError(
+          f'Tried to construct xm.SequentialArgs from {collection!r} of type '
+          f'{type(collection)}. Expected a mapping, a sequence or '
+          'xm.SequentialArgs.')
     return result
 
   def to_list(
@@ -129,22 +123,15 @@ class SequentialArgs:
       kwargs_joiner: Callable[[str, str], str] = utils.trivial_kwargs_joiner
   ) -> List[str]:
     """Exports items as a list ready to be passed into the command line."""
-
-    def export_regular_item(item: SequentialArgs._RegularItem) -> str:
-      return escaper(item.value)
-
-    def export_keyword_item(item: SequentialArgs._KeywordItem) -> str:
-      value = self._kwvalues[item.name]
-      if isinstance(value, bool):
-        return escaper(f"--{'' if value else 'no'}{item.name}")
+    result = []
+    for name, value in self._items:
+      if name is None:
+        result.append(escaper(value))
+      elif isinstance(value, bool):
+        result.append(escaper(f"--{'' if value else 'no'}{name}"))
       else:
-        return kwargs_joiner(escaper(f'--{item.name}'), escaper(value))
-
-    matcher = pattern_matching.match(
-        export_regular_item,
-        export_keyword_item,
-    )
-    return [matcher(item) for item in self._items]
+        result.append(kwargs_joiner(escaper(f'--{name}'), escaper(value)))
+    return result
 
   def to_dict(self, kwargs_only: bool = False) -> Dict[str, Any]:
     """Exports items as a dictionary.
@@ -156,27 +143,17 @@ class SequentialArgs:
       The sought dictionary.
     """
     if kwargs_only:
-      return self._kwvalues
-
-    def export_regular_item(
-        item: SequentialArgs._RegularItem) -> Tuple[str, Any]:
-      return (str(item.value), True)
-
-    def export_keyword_item(
-        item: SequentialArgs._KeywordItem) -> Tuple[str, Any]:
-      return (item.name, self._kwvalues[item.name])
-
-    matcher = pattern_matching.match(
-        export_regular_item,
-        export_keyword_item,
-    )
-    return dict([matcher(item) for item in self._items])
+      return {name: value for name, value in self._items if name is not None}
+    result = {}
+    for name, value in self._items:
+      if name is None:
+        result[str(value)] = True
+      else:
+        result[name] = value
+    return result
 
   def __eq__(self, other) -> bool:
-    return isinstance(other, SequentialArgs) and all([
-        self._items == other._items,
-        self._kwvalues == other._kwvalues,
-    ])
+    return isinstance(other, SequentialArgs) and self._items == other._items
 
   def __repr__(self) -> str:
     return f"[{', '.join(self.to_list(repr))}]"
@@ -186,6 +163,11 @@ def merge_args(*operands: Union[SequentialArgs, UserArgs]) -> SequentialArgs:
   """Merges several arguments collections into one left-to-right."""
   result = SequentialArgs()
   for operand in operands:
+    if isinstance(operand, collections.abc.Mapping):
+      # Mappings are the most common operand, merge them without building an
+      # intermediate SequentialArgs.
+      result._merge_from_mapping(operand)  # pylint: disable=protected-access
+      continue
     if not isinstance(operand, SequentialArgs):
       operand = SequentialArgs.from_collection(operand)
     result._merge_from(operand)  # pylint: disable=protected-access
@@ -350,6 +332,8 @@ class JobGroup:
     constraints: A list of additional scheduling constraints.
   """
 
+  __slots__ = ('jobs', 'constraints')
+
   jobs: Dict[str, JobType]
   constraints: List[Constraint]
 
@@ -363,8 +347,14 @@ class JobGroup:
       constraints: List of additional scheduling constraints. Keyword only arg.
       **jobs: Jobs / job groups that constitute the group passed as kwargs.
     """
+    # `jobs` is already a fresh dict built from the keyword arguments.
     self.jobs = jobs
-    self.constraints = list(constraints) if constraints else []
+    if not constraints:
+      self.constraints = []
+    elif type(constraints) is list:  # pylint: disable=unidiomatic-typecheck
+      self.constraints = constraints
+    else:
+      self.constraints = list(constraints)
 
 
 JobTypeVar = TypeVar('JobTypeVar', Job, JobGroup, JobGeneratorType)
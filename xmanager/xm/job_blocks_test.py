@@ -55,6 +55,13 @@ class JobBlocksTest(unittest.TestCase):
     self.assertEqual(
         args.to_list(str), ['1', '--a=z', '--b=x', '2', '--c=t', '3'])
 
+  def test_merge_args_override_keeps_position(self):
+    args = job_blocks.merge_args({'a': 1, 'b': 2}, ['c'], {'a': 3})
+
+    self.assertEqual(args.to_list(str), ['--a=3', '--b=2', 'c'])
+    self.assertEqual(args.to_dict(kwargs_only=True), {'a': 3, 'b': 2})
+    self.assertEqual(args, job_blocks.merge_args({'a': 3, 'b': 2}, ['c']))
+
   def test_to_dict(self):
     args = job_blocks.merge_args(['--knob'], {1: False})
 
@@ -72,6 +79,10 @@ class JobBlocksTest(unittest.TestCase):
         "Wrap it in a list: \\['--foo'\\] to make it a single argument."):
       job_blocks.SequentialArgs.from_collection('--foo')
 
+  def test_sequential_args_from_unsupported_type(self):
+    with self.assertRaises(TypeError):
+      job_blocks.SequentialArgs.from_collection(42)
+
 
 if __name__ == '__main__':
   unittest.main()
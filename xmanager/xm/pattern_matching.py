@@ -21,7 +21,7 @@ API is not final.
 """
 
 import inspect
-from typing import Any, Awaitable, Callable, Iterable, Generic, Tuple, Type, TypeVar, Union
+from typing import Any, Awaitable, Callable, Dict, Iterable, Generic, Tuple, Type, TypeVar, Union
 
 R = TypeVar('R')
 
@@ -56,9 +56,11 @@ class Case(Generic[R]):
     if len(values) != len(self.kind):
       return False
 
-    return all(
-        expected_type is Any or isinstance(value, expected_type)
-        for expected_type, value in zip(self.kind, values))
+    # A plain loop avoids allocating a generator on every dispatch.
+    for expected_type, value in zip(self.kind, values):
+      if expected_type is not Any and not isinstance(value, expected_type):
+        return False
+    return True
 
 
 def _deduce_types(handler: Callable[..., Any]) -> Tuple[Type[Any]]:
@@ -107,12 +109,20 @@ def match(*handlers: Union[Case[R], Callable[..., R]]) -> Callable[..., R]:
           _deduce_types(handler), handler) for handler in handlers
   ]
 
+  # Whether a case matches only depends on the types of the values, so the
+  # matching case is looked up once per combination of types.
+  matching_cases: Dict[Tuple[Type[Any], ...], Case[R]] = {}
+
   def apply(*values: Any) -> R:
+    value_types = tuple(type(value) for value in values)
+    case = matching_cases.get(value_types)
+    if case is not None:
+      return case.handle(*values)
     for case in cases:
       if case.matches(*values):
+        matching_cases[value_types] = case
         return case.handle(*values)
 
-    value_types = tuple(type(value) for value in values)
     known_types = '\n'.join(str(case.kind) for case in cases)
     raise TypeError(f'{values} did not match any type pattern. Values have '
                     f'following types:\n'
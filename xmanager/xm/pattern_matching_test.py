@@ -91,6 +91,22 @@ class UtilsTest(unittest.TestCase):
 
     self.assertEqual(pattern_matching.match(first_element)([1, 2]), 1)
 
+  def testMatch_repeatedCallsKeepEarliestCase(self):
+
+    def visit_bool(b: bool):
+      return f'bool {b}'
+
+    def visit_int(n: int):
+      return f'int {n}'
+
+    matcher = pattern_matching.match(visit_bool, visit_int)
+
+    for _ in range(2):
+      self.assertEqual(matcher(True), 'bool True')
+      self.assertEqual(matcher(1), 'int 1')
+      with self.assertRaises(TypeError):
+        matcher('zzz')
+
   def testMatch_missingAnnotation(self):
     with self.assertRaises(ValueError):
       pattern_matching.match(lambda x: x)
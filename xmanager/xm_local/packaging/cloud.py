@@ -12,7 +12,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """Packaging for execution on Cloud."""
-from typing import Any, Optional
+from concurrent import futures
+import functools
+import re
+import shutil
+from typing import Any, List, Optional, Pattern, Sequence, Set, Tuple
+
+from absl import flags
+from absl import logging
+from docker.utils import utils as docker_utils
 
 from xmanager import xm
 from xmanager.cloud import auth
@@ -23,25 +31,90 @@ from xmanager.xm import pattern_matching
 from xmanager.xm_local import executables as local_executables
 from xmanager.xm_local import executors as local_executors
 
+_IMAGE_COPY_CONCURRENCY = flags.DEFINE_integer(
+    'xm_image_copy_concurrency', None,
+    'Number of layers to copy concurrently when skopeo copies an xm.Container '
+    'image to the project registry. Requires skopeo 1.14+.')
+
+# (source, destination) pairs of images known to have been copied already.
+_copied_images: Set[Tuple[str, str]] = set()
+# Images of PythonContainers built and pushed in this process, along with what
+# they were built from. See _package_python_container.
+_built_images: List[Tuple[Tuple[Any, ...], str]] = []
+
+
+def _gcr_prefix() -> str:
+  """Returns the Container Registry prefix of the project.
+
+  auth.get_project_name() is cached, so only the first call reaches the
+  metadata server or gcloud.
+  """
+  return 'gcr.io/' + auth.get_project_name()
+
+
+@functools.lru_cache()
+def _project_registry_pattern(project: str) -> Pattern[str]:
+  """Matches images in the Container or Artifact Registry of the project."""
+  project = re.escape(project)
+  return re.compile(rf'((us|eu|asia)\.)?gcr\.io/{project}/'
+                    rf'|[a-z0-9-]+-docker\.pkg\.dev/{project}/')
+
+
+def _is_in_project_registry(image: str) -> bool:
+  return bool(
+      _project_registry_pattern(auth.get_project_name()).match(image))
+
+
+def _get_push_image_tag_caip(spec: local_executors.CaipSpec):
+  return spec.push_image_tag
+
+
+def _get_push_image_tag_kubernetes(spec: local_executors.KubernetesSpec):
+  return spec.push_image_tag
+
+
+def _throw_on_unknown_executor(executor: Any):
+  raise TypeError(f'Unsupported executor specification: {executor!r}. ')
+
+
+_PUSH_IMAGE_TAG_ROUTER = pattern_matching.match(
+    _get_push_image_tag_caip,
+    _get_push_image_tag_kubernetes,
+    _throw_on_unknown_executor,
+)
+
 
 def _get_push_image_tag(executor_spec: xm.ExecutorSpec) -> Optional[str]:
   """Get the push_image_tag from executor or None."""
+  return _PUSH_IMAGE_TAG_ROUTER(executor_spec)
 
-  def _get_push_image_tag_caip(spec: local_executors.CaipSpec):
-    return spec.push_image_tag
 
-  def _get_push_image_tag_kubernetes(spec: local_executors.KubernetesSpec):
-    return spec.push_image_tag
+def _is_copied(source: str, destination: str, use_skopeo: bool) -> bool:
+  """Checks whether the destination image is already a copy of the source.
 
-  def _throw_on_unknown_executor(executor: Any):
-    raise TypeError(f'Unsupported executor specification: {executor!r}. ')
+  Besides the copies made in this process, images are compared by digest in
+  their registries when skopeo is used. skopeo copies the linux/amd64 image of
+  a multi-platform source, so the destination has the digest of that platform.
+  A Docker daemon pull and push copies the platform of the local machine, so
+  the digests are not compared without skopeo.
 
-  return pattern_matching.match(
-      _get_push_image_tag_caip,
-      _get_push_image_tag_kubernetes,
-      _throw_on_unknown_executor,
-  )(
-      executor_spec)
+  Args:
+    source: The image to copy.
+    destination: The name to copy the image to.
+    use_skopeo: Whether the image is copied with skopeo.
+
+  Returns:
+    Whether the copy can be skipped.
+  """
+  if (source, destination) in _copied_images:
+    return True
+  if not use_skopeo:
+    return False
+  # Both lookups are a registry round-trip, so they are done concurrently.
+  with futures.ThreadPoolExecutor(max_workers=2) as executor:
+    source_digest, destination_digest = executor.map(
+        docker_lib.get_registry_digest, [source, destination])
+  return source_digest is not None and source_digest == destination_digest
 
 
 def _package_container(packageable: xm.Packageable,
@@ -52,12 +125,20 @@ def _package_container(packageable: xm.Packageable,
   remote Cloud registry, the user should push the image before running XManager,
   because XManager will not push a local image in the packaging step.
 
-  Unless the container's image path already matches the GCR project prefix, we
-  always pull the container and push it to push_image_tag location. This avoids
-  a potential permissions error where the user has permissions to read an image,
-  but the Cloud service agent does not have permissions. If container.image_path
-  already points to the GCR project, we skip pushing because the image should
-  already be in the destination location.
+  Unless the container's image path already points to the project's Container
+  Registry (in any region) or Artifact Registry, we always copy the container
+  to push_image_tag location. This avoids a potential permissions error where
+  the user has permissions to read an image, but the Cloud service agent does
+  not have permissions. If container.image_path already points to the project,
+  we skip pushing because the image should already be in the destination
+  location. With skopeo, the copy is skipped as well if the image at
+  push_image_tag already has the same digest.
+
+  The image is copied between the registries with skopeo if it is installed.
+  Otherwise it is pulled to the local Docker daemon and pushed from there.
+  When both images are in the same registry, skopeo and the Docker daemon both
+  mount the existing layers into the destination repository rather than
+  uploading them again.
 
   Args:
     packageable: Packageable containing Executor and Executable.
@@ -66,9 +147,10 @@ def _package_container(packageable: xm.Packageable,
   Returns:
     GoogleContainerRegistryImage Executable.
   """
-  gcr_project_prefix = 'gcr.io/' + auth.get_project_name()
-  if container.image_path.startswith(
-      gcr_project_prefix) or not docker_lib.is_docker_installed():
+  gcr_project_prefix = _gcr_prefix()
+  use_skopeo = shutil.which('skopeo') is not None
+  if _is_in_project_registry(container.image_path) or not (
+      use_skopeo or docker_lib.is_docker_installed()):
     return local_executables.GoogleContainerRegistryImage(
         name=packageable.executable_spec.name,
         image_path=container.image_path,
@@ -76,24 +158,32 @@ def _package_container(packageable: xm.Packageable,
         env_vars=packageable.env_vars,
     )
 
-  instance = docker_adapter.instance()
-  client = instance.get_client()
-  print(f'Pulling {container.image_path}...')
-  repository, tag = instance.split_tag(container.image_path)
-  image_id = instance.pull_image(container.image_path)
-  image = client.images.get(image_id)
-
+  repository, tag = docker_utils.parse_repository_tag(container.image_path)
+  tag = tag or 'latest'
   push_image_tag = _get_push_image_tag(packageable.executor_spec)
   if not push_image_tag:
-    if repository.startswith(gcr_project_prefix):
+    if _is_in_project_registry(repository):
       # If the image path already points to the project's GCR, reuse it.
       push_image_tag = f'{repository}:{tag}'
     else:
       # Otherwise, create a new image repository inside the project's GCR.
       push_image_tag = f'{gcr_project_prefix}/{repository}:{tag}'
-  image.tag(push_image_tag)
-  print(f'Pushing {push_image_tag}...')
-  client.images.push(push_image_tag)
+
+  if _is_copied(container.image_path, push_image_tag, use_skopeo):
+    logging.info('%s is up to date.', push_image_tag)
+  elif use_skopeo:
+    # Copy directly between the registries rather than through the daemon.
+    logging.info('Copying %s to %s...', container.image_path, push_image_tag)
+    docker_lib.copy_image(container.image_path, push_image_tag,
+                          _IMAGE_COPY_CONCURRENCY.value)
+  else:
+    instance = docker_adapter.instance()
+    logging.info('Pulling %s...', container.image_path)
+    image_id = instance.pull_image(container.image_path)
+    instance.tag_image(image_id, push_image_tag)
+    logging.info('Pushing %s...', push_image_tag)
+    instance.push_image(push_image_tag)
+  _copied_images.add((container.image_path, push_image_tag))
   return local_executables.GoogleContainerRegistryImage(
       name=packageable.executable_spec.name,
       image_path=push_image_tag,
@@ -106,14 +196,11 @@ def _package_dockerfile(packageable: xm.Packageable, dockerfile: xm.Dockerfile):
   """Matcher method for packaging `xm.Dockerfile`."""
   push_image_tag = _get_push_image_tag(packageable.executor_spec)
   if not push_image_tag:
-    gcr_project_prefix = 'gcr.io/' + auth.get_project_name()
     tag = docker_lib.create_tag()
-    push_image_tag = f'{gcr_project_prefix}/{dockerfile.name}:{tag}'
+    push_image_tag = f'{_gcr_prefix()}/{dockerfile.name}:{tag}'
 
-  image = build_image.build_by_dockerfile(dockerfile.path,
-                                          dockerfile.dockerfile, push_image_tag)
-  if docker_lib.is_docker_installed():
-    build_image.push(image)
+  build_image.build_by_dockerfile(
+      dockerfile.path, dockerfile.dockerfile, push_image_tag, push=True)
   return local_executables.GoogleContainerRegistryImage(
       name=packageable.executable_spec.name,
       image_path=push_image_tag,
@@ -122,15 +209,54 @@ def _package_dockerfile(packageable: xm.Packageable, dockerfile: xm.Dockerfile):
   )
 
 
+def _find_equal(items: Sequence[Any], item: Any) -> Optional[int]:
+  """Returns the index of the first item equal to `item`, or None if none is.
+
+  Specs are unhashable attrs classes, so they are looked up by equality.
+  """
+  try:
+    return items.index(item)
+  except ValueError:
+    return None
+
+
+def _get_built_image(key: Tuple[Any, ...]) -> Optional[str]:
+  index = _find_equal([built_key for built_key, _ in _built_images], key)
+  return None if index is None else _built_images[index][1]
+
+
 def _package_python_container(
     packageable: xm.Packageable,
     python_container: xm.PythonContainer) -> xm.Executable:
-  """Matcher method for packaging `xm.PythonContainer`."""
+  """Matcher method for packaging `xm.PythonContainer`.
+
+  Args and env vars are baked into the image, so an image is only reused for
+  the same container, args, env vars and push tag, and if none of the project
+  files changed since it was built.
+
+  Args:
+    packageable: Packageable containing Executor and Executable.
+    python_container: PythonContainer to build.
+
+  Returns:
+    GoogleContainerRegistryImage Executable.
+  """
   push_image_tag = _get_push_image_tag(packageable.executor_spec)
-  image = build_image.build(python_container, packageable.args,
-                            packageable.env_vars, push_image_tag)
-  if docker_lib.is_docker_installed():
-    build_image.push(image)
+  project_digest = build_image.get_project_digest(python_container.path)
+  key = (python_container, packageable.args, packageable.env_vars,
+         push_image_tag, project_digest)
+  image = _get_built_image(key)
+  if image:
+    logging.info('Reusing %s.', image)
+  else:
+    image = build_image.build(
+        python_container,
+        packageable.args,
+        packageable.env_vars,
+        push_image_tag,
+        push=True,
+        project_digest=project_digest)
+    _built_images.append((key, image))
   return local_executables.GoogleContainerRegistryImage(
       name=packageable.executable_spec.name,
       image_path=image,
@@ -155,3 +281,33 @@ def package_cloud_executable(
     packageable: xm.Packageable,
     executable_spec: xm.ExecutableSpec) -> xm.Executable:
   return _CLOUD_PACKAGING_ROUTER(packageable, executable_spec)
+
+
+def package_cloud_executables(
+    packageables: Sequence[xm.Packageable]) -> List[xm.Executable]:
+  """Packages several packageables for execution on Cloud.
+
+  Identical packageables, e.g. the same PythonContainer used by several work
+  units, are only packaged once. The distinct ones are packaged concurrently if
+  --xm_parallel_builds is set.
+
+  Args:
+    packageables: The packageables to package.
+
+  Returns:
+    The executables, in the order of `packageables`.
+  """
+  unique_packageables: List[xm.Packageable] = []
+  indices: List[int] = []
+  for packageable in packageables:
+    index = _find_equal(unique_packageables, packageable)
+    if index is None:
+      index = len(unique_packageables)
+      unique_packageables.append(packageable)
+    indices.append(index)
+
+  def package(packageable: xm.Packageable) -> xm.Executable:
+    return package_cloud_executable(packageable, packageable.executable_spec)
+
+  executables = build_image.parallel_map(package, unique_packageables)
+  return [executables[index] for index in indices]
@@ -0,0 +1,127 @@
+import os
+from unittest import mock
+
+from absl.testing import absltest
+from xmanager import xm
+from xmanager.cloud import auth
+from xmanager.cloud import build_image
+from xmanager.cloud import docker_lib
+from xmanager.xm_local import executors as local_executors
+from xmanager.xm_local.packaging import cloud
+
+
+class CloudPackagingTest(absltest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.enter_context(mock.patch.object(cloud, '_copied_images', set()))
+    self.enter_context(mock.patch.object(cloud, '_built_images', []))
+
+  def create_packageable(self, image_path):
+    return xm.Packageable(
+        executable_spec=xm.Container(image_path=image_path),
+        executor_spec=local_executors.Caip.Spec(),
+    )
+
+  @mock.patch.object(auth, 'get_project_name', return_value='project')
+  @mock.patch.object(cloud.shutil, 'which', return_value='/usr/bin/skopeo')
+  @mock.patch.object(
+      docker_lib, 'get_registry_digest', side_effect=['sha256:a', None])
+  @mock.patch.object(docker_lib, 'copy_image')
+  def test_package_container_copies_with_skopeo(self, copy_image, *_):
+    packageable = self.create_packageable('python:3.9')
+    executable = cloud.package_cloud_executable(packageable,
+                                                packageable.executable_spec)
+    self.assertEqual(executable.image_path, 'gcr.io/project/python:3.9')
+    copy_image.assert_called_once_with('python:3.9',
+                                       'gcr.io/project/python:3.9', None)
+
+  @mock.patch.object(auth, 'get_project_name', return_value='project')
+  @mock.patch.object(cloud.shutil, 'which', return_value='/usr/bin/skopeo')
+  @mock.patch.object(
+      docker_lib, 'get_registry_digest', return_value='sha256:a')
+  @mock.patch.object(docker_lib, 'copy_image')
+  def test_package_container_skips_copy_of_same_digest(self, copy_image,
+                                                        get_registry_digest,
+                                                        *_):
+    packageable = self.create_packageable('python:3.9')
+    cloud.package_cloud_executable(packageable, packageable.executable_spec)
+    cloud.package_cloud_executable(packageable, packageable.executable_spec)
+    copy_image.assert_not_called()
+    self.assertEqual(get_registry_digest.call_count, 2)
+
+  @mock.patch.object(auth, 'get_project_name', return_value='project')
+  @mock.patch.object(cloud.shutil, 'which', return_value=None)
+  @mock.patch.object(docker_lib, 'is_docker_installed', return_value=True)
+  @mock.patch.object(cloud.docker_adapter, 'instance')
+  def test_package_container_pulls_and_pushes(self, instance, *_):
+    adapter = instance.return_value
+    adapter.pull_image.return_value = 'sha256:id'
+    packageable = self.create_packageable('python:3.9')
+    cloud.package_cloud_executable(packageable, packageable.executable_spec)
+    adapter.tag_image.assert_called_once_with('sha256:id',
+                                              'gcr.io/project/python:3.9')
+    adapter.push_image.assert_called_once_with('gcr.io/project/python:3.9')
+
+  @mock.patch.object(auth, 'get_project_name', return_value='project')
+  @mock.patch.object(docker_lib, 'copy_image')
+  def test_package_container_in_project_registry(self, copy_image, _):
+    packageable = self.create_packageable('gcr.io/project/image:tag')
+    executable = cloud.package_cloud_executable(packageable,
+                                                packageable.executable_spec)
+    self.assertEqual(executable.image_path, 'gcr.io/project/image:tag')
+    copy_image.assert_not_called()
+
+  @mock.patch.object(auth, 'get_project_name', return_value='project')
+  @mock.patch.object(docker_lib, 'copy_image')
+  def test_package_cloud_executables_deduplicates(self, *_):
+    first = self.create_packageable('gcr.io/project/first')
+    second = self.create_packageable('gcr.io/project/second')
+    with mock.patch.object(
+        cloud, 'package_cloud_executable',
+        wraps=cloud.package_cloud_executable) as package_cloud_executable:
+      executables = cloud.package_cloud_executables([
+          first,
+          second,
+          self.create_packageable('gcr.io/project/first'),
+      ])
+    self.assertEqual(package_cloud_executable.call_count, 2)
+    self.assertEqual([executable.image_path for executable in executables], [
+        'gcr.io/project/first',
+        'gcr.io/project/second',
+        'gcr.io/project/first',
+    ])
+
+  @mock.patch.object(build_image, 'build', return_value='gcr.io/project/image')
+  def test_package_python_container_reuses_image(self, build):
+    path = self.create_tempdir().full_path
+    packageable = xm.Packageable(
+        executable_spec=xm.PythonContainer(
+            path=path, entrypoint=xm.ModuleName('main')),
+        executor_spec=local_executors.Caip.Spec(),
+        args={'seed': 1},
+    )
+    for _ in range(2):
+      executable = cloud.package_cloud_executable(packageable,
+                                                  packageable.executable_spec)
+      self.assertEqual(executable.image_path, 'gcr.io/project/image')
+    build.assert_called_once()
+    self.assertTrue(build.call_args[1]['push'])
+
+    self.create_tempfile(os.path.join(path, 'main.py'))
+    cloud.package_cloud_executable(packageable, packageable.executable_spec)
+    self.assertEqual(build.call_count, 2)
+
+  @mock.patch.object(auth, 'get_project_name', return_value='project')
+  def test_is_in_project_registry(self, _):
+    self.assertTrue(cloud._is_in_project_registry('gcr.io/project/image'))
+    self.assertTrue(cloud._is_in_project_registry('eu.gcr.io/project/image'))
+    self.assertTrue(
+        cloud._is_in_project_registry(
+            'us-central1-docker.pkg.dev/project/repository/image:tag'))
+    self.assertFalse(cloud._is_in_project_registry('gcr.io/project2/image'))
+    self.assertFalse(cloud._is_in_project_registry('python:3.9'))
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -25,18 +25,6 @@ from xmanager.xm_local.packaging import cloud as cloud_packaging
 from xmanager.xm_local.packaging import local as local_packaging
 
 
-def _visit_caip_spec(
-    bazel_outputs: bazel_tools.TargetOutputs,
-    packageable: xm.Packageable,
-    _: executors.CaipSpec,
-):
-  del bazel_outputs
-  return cloud_packaging.package_cloud_executable(
-      packageable,
-      packageable.executable_spec,
-  )
-
-
 def _visit_local_spec(
     bazel_outputs: bazel_tools.TargetOutputs,
     packageable: xm.Packageable,
@@ -49,18 +37,6 @@ def _visit_local_spec(
   )
 
 
-def _visit_kubernetes_spec(
-    bazel_outputs: bazel_tools.TargetOutputs,
-    packageable: xm.Packageable,
-    _: executors.KubernetesSpec,
-):
-  del bazel_outputs
-  return cloud_packaging.package_cloud_executable(
-      packageable,
-      packageable.executable_spec,
-  )
-
-
 def _throw_on_unknown_executor(
     bazel_outputs: bazel_tools.TargetOutputs,
     packageable: xm.Packageable,
@@ -70,13 +46,15 @@ def _throw_on_unknown_executor(
                   f'Packageable: {packageable!r}')
 
 
+# Packageables of Cloud executors are not routed, see `package`.
 _PACKAGING_ROUTER = pattern_matching.match(
-    _visit_caip_spec,
     _visit_local_spec,
-    _visit_kubernetes_spec,
     _throw_on_unknown_executor,
 )
 
+# Executors whose packageables are packaged together by the Cloud packager.
+_CLOUD_EXECUTOR_SPECS = (executors.CaipSpec, executors.KubernetesSpec)
+
 
 def _normalize_label(label: str, kind: str) -> str:
   """Attempts to correct the label if it does not point to the right target.
@@ -126,7 +104,16 @@ def package(packageables: Sequence[xm.Packageable]) -> List[xm.Executable]:
       for target, output in zip(targets, outputs):
         built_targets[target] = output
 
+  # Cloud packageables are packaged as a batch so that identical ones are only
+  # built once and the others can be built concurrently.
+  cloud_executables = iter(
+      cloud_packaging.package_cloud_executables([
+          packageable for packageable in packageables
+          if isinstance(packageable.executor_spec, _CLOUD_EXECUTOR_SPECS)
+      ]))
   return [
+      next(cloud_executables)
+      if isinstance(packageable.executor_spec, _CLOUD_EXECUTOR_SPECS) else
       _PACKAGING_ROUTER(built_targets, packageable, packageable.executor_spec)
       for packageable in packageables
   ]